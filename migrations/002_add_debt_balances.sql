@@ -0,0 +1,66 @@
+-- Per-debt balances kept up to date from payments, so that reading the
+-- debts of a bill does not need to aggregate payments.
+ALTER TABLE debts
+ADD paid_amount REAL NOT NULL DEFAULT 0,
+ADD pending_flag BOOLEAN NOT NULL DEFAULT FALSE,
+ADD forced_flag BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE OR REPLACE FUNCTION refresh_debt_balance(d_id INTEGER)
+RETURNS VOID AS $$
+	UPDATE debts d SET
+		paid_amount = COALESCE(p.paid_amount, 0),
+		pending_flag = COALESCE(p.pending_flag, FALSE),
+		forced_flag = COALESCE(p.forced_flag, FALSE)
+	FROM (
+		SELECT
+			SUM(amount) FILTER (
+				WHERE confirmed_at IS NOT NULL AND NOT is_deleted
+			) AS paid_amount,
+			BOOL_OR(confirmed_at IS NULL AND NOT is_deleted) AS pending_flag,
+			BOOL_OR(
+				is_forced AND confirmed_at IS NOT NULL AND NOT is_deleted
+			) AS forced_flag
+		FROM payments
+		WHERE debt_id = d_id
+	) p
+	WHERE d.id = d_id;
+$$ LANGUAGE SQL;
+
+CREATE OR REPLACE FUNCTION payments_refresh_debt_balance()
+RETURNS TRIGGER AS $$
+BEGIN
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM refresh_debt_balance(OLD.debt_id);
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		IF TG_OP = 'INSERT' OR NEW.debt_id IS DISTINCT FROM OLD.debt_id THEN
+			PERFORM refresh_debt_balance(NEW.debt_id);
+		END IF;
+	END IF;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER payments_debt_balance
+AFTER INSERT OR UPDATE OR DELETE ON payments
+FOR EACH ROW EXECUTE PROCEDURE payments_refresh_debt_balance();
+
+-- Backfill existing debts
+UPDATE debts d SET
+	paid_amount = COALESCE(p.paid_amount, 0),
+	pending_flag = COALESCE(p.pending_flag, FALSE),
+	forced_flag = COALESCE(p.forced_flag, FALSE)
+FROM (
+	SELECT
+		debt_id,
+		SUM(amount) FILTER (
+			WHERE confirmed_at IS NOT NULL AND NOT is_deleted
+		) AS paid_amount,
+		BOOL_OR(confirmed_at IS NULL AND NOT is_deleted) AS pending_flag,
+		BOOL_OR(
+			is_forced AND confirmed_at IS NOT NULL AND NOT is_deleted
+		) AS forced_flag
+	FROM payments
+	GROUP BY debt_id
+) p
+WHERE d.id = p.debt_id;
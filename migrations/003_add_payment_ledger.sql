@@ -0,0 +1,84 @@
+-- Append-only ledger of payment state changes. A payment row only holds
+-- what never changes; its current status is its latest event.
+-- status: 0 = withdrawn, 1 = pending, 2 = confirmed, 3 = force confirmed
+CREATE TABLE payment_events (
+	id BIGSERIAL PRIMARY KEY,
+	payment_id INTEGER NOT NULL REFERENCES payments(id),
+	debt_id INTEGER NOT NULL REFERENCES debts(id),
+	status SMALLINT NOT NULL,
+	paid_delta REAL NOT NULL DEFAULT 0,
+	pending_delta SMALLINT NOT NULL DEFAULT 0,
+	forced_delta SMALLINT NOT NULL DEFAULT 0,
+	-- id of the transaction that appended the event
+	txid BIGINT NOT NULL DEFAULT txid_current(),
+	created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX payment_events_payment_id_idx ON payment_events (payment_id, id);
+CREATE INDEX payment_events_debt_id_idx ON payment_events (debt_id, txid);
+
+-- Per-debt balances folded from the payment_events appended by
+-- transactions before event_txid. Every such transaction had ended when
+-- the snapshot was taken, so no event can be added below it later.
+-- Current balance = snapshot + events with txid >= event_txid.
+CREATE TABLE debt_balances (
+	debt_id INTEGER PRIMARY KEY REFERENCES debts(id),
+	event_txid BIGINT NOT NULL,
+	paid_amount REAL NOT NULL DEFAULT 0,
+	pending_count INTEGER NOT NULL DEFAULT 0,
+	forced_count INTEGER NOT NULL DEFAULT 0,
+	updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Backfill one event per existing payment from its current state
+INSERT INTO payment_events (payment_id, debt_id, status, paid_delta,
+	pending_delta, forced_delta, created_at)
+SELECT p.id, p.debt_id,
+	CASE
+		WHEN COALESCE(p.is_deleted, FALSE) THEN 0
+		WHEN p.confirmed_at IS NULL THEN 1
+		WHEN COALESCE(p.is_forced, FALSE) THEN 3
+		ELSE 2
+	END,
+	CASE
+		WHEN NOT COALESCE(p.is_deleted, FALSE)
+			AND p.confirmed_at IS NOT NULL THEN p.amount
+		ELSE 0
+	END,
+	CASE
+		WHEN NOT COALESCE(p.is_deleted, FALSE)
+			AND p.confirmed_at IS NULL THEN 1
+		ELSE 0
+	END,
+	CASE
+		WHEN NOT COALESCE(p.is_deleted, FALSE)
+			AND p.confirmed_at IS NOT NULL
+			AND COALESCE(p.is_forced, FALSE) THEN 1
+		ELSE 0
+	END,
+	COALESCE(p.confirmed_at, p.created_at)
+FROM payments p
+ORDER BY p.id;
+
+-- Snapshot every backfilled event
+INSERT INTO debt_balances (debt_id, event_txid, paid_amount, pending_count,
+	forced_count)
+SELECT debt_id, MAX(txid) + 1, SUM(paid_delta), SUM(pending_delta),
+	SUM(forced_delta)
+FROM payment_events
+GROUP BY debt_id;
+
+-- Balances are no longer maintained on debts on every payment write
+DROP TRIGGER payments_debt_balance ON payments;
+DROP FUNCTION payments_refresh_debt_balance();
+DROP FUNCTION refresh_debt_balance(INTEGER);
+
+ALTER TABLE debts
+DROP paid_amount,
+DROP pending_flag,
+DROP forced_flag;
+
+ALTER TABLE payments
+DROP is_deleted,
+DROP confirmed_at,
+DROP is_forced;
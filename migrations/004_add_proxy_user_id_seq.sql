@@ -0,0 +1,10 @@
+-- Ids of users added by name, counting down from -1
+CREATE SEQUENCE proxy_user_id_seq
+INCREMENT BY -1
+MINVALUE -2147483648
+MAXVALUE -1
+START WITH -1;
+
+-- Continue below the proxy users added so far
+SELECT setval('proxy_user_id_seq', LEAST(COALESCE(MIN(id), 0), 0) - 1, FALSE)
+FROM users;
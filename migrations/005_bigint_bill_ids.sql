@@ -0,0 +1,120 @@
+-- Bills get BIGINT ids. The 16 character id stays on as bills.token, which
+-- is what /start deep links use.
+
+-- Part 1: expand. Safe to run while the previous version of the bot is
+-- still serving; nothing here takes long locks.
+CREATE SEQUENCE bills_id_seq;
+
+ALTER TABLE bills ADD new_id BIGINT;
+ALTER TABLE bills ALTER new_id SET DEFAULT nextval('bills_id_seq');
+UPDATE bills SET new_id = nextval('bills_id_seq') WHERE new_id IS NULL;
+
+ALTER TABLE items ADD bill_new_id BIGINT;
+ALTER TABLE bill_taxes ADD bill_new_id BIGINT;
+ALTER TABLE bill_shares ADD bill_new_id BIGINT;
+ALTER TABLE debts ADD bill_new_id BIGINT;
+
+-- Keeps bill_new_id filled in for rows written by the previous version
+CREATE FUNCTION set_bill_new_id()
+RETURNS TRIGGER AS $$
+BEGIN
+	NEW.bill_new_id := (SELECT b.new_id FROM bills b WHERE b.id = NEW.bill_id);
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER items_bill_new_id
+BEFORE INSERT OR UPDATE OF bill_id ON items
+FOR EACH ROW EXECUTE PROCEDURE set_bill_new_id();
+CREATE TRIGGER bill_taxes_bill_new_id
+BEFORE INSERT OR UPDATE OF bill_id ON bill_taxes
+FOR EACH ROW EXECUTE PROCEDURE set_bill_new_id();
+CREATE TRIGGER bill_shares_bill_new_id
+BEFORE INSERT OR UPDATE OF bill_id ON bill_shares
+FOR EACH ROW EXECUTE PROCEDURE set_bill_new_id();
+CREATE TRIGGER debts_bill_new_id
+BEFORE INSERT OR UPDATE OF bill_id ON debts
+FOR EACH ROW EXECUTE PROCEDURE set_bill_new_id();
+
+UPDATE items t SET bill_new_id = b.new_id
+FROM bills b WHERE b.id = t.bill_id AND t.bill_new_id IS NULL;
+UPDATE bill_taxes t SET bill_new_id = b.new_id
+FROM bills b WHERE b.id = t.bill_id AND t.bill_new_id IS NULL;
+UPDATE bill_shares t SET bill_new_id = b.new_id
+FROM bills b WHERE b.id = t.bill_id AND t.bill_new_id IS NULL;
+UPDATE debts t SET bill_new_id = b.new_id
+FROM bills b WHERE b.id = t.bill_id AND t.bill_new_id IS NULL;
+
+CREATE UNIQUE INDEX CONCURRENTLY bills_new_id_key ON bills (new_id);
+CREATE UNIQUE INDEX CONCURRENTLY bills_token_key ON bills (id);
+CREATE UNIQUE INDEX CONCURRENTLY bill_shares_user_id_bill_new_id_item_id_key
+ON bill_shares (user_id, bill_new_id, item_id);
+CREATE UNIQUE INDEX CONCURRENTLY debts_debtor_id_creditor_id_bill_new_id_key
+ON debts (debtor_id, creditor_id, bill_new_id);
+
+-- Part 2: swap. Run together with deploying the new version. Only catalog
+-- changes, apart from the NOT NULL check on bills.
+BEGIN;
+
+DROP TRIGGER items_bill_new_id ON items;
+DROP TRIGGER bill_taxes_bill_new_id ON bill_taxes;
+DROP TRIGGER bill_shares_bill_new_id ON bill_shares;
+DROP TRIGGER debts_bill_new_id ON debts;
+DROP FUNCTION set_bill_new_id();
+
+ALTER TABLE items DROP CONSTRAINT items_bill_id_fkey;
+ALTER TABLE bill_taxes DROP CONSTRAINT bill_taxes_bill_id_fkey;
+ALTER TABLE bill_shares DROP CONSTRAINT bill_shares_bill_id_fkey;
+ALTER TABLE debts DROP CONSTRAINT debts_bill_id_fkey;
+ALTER TABLE bill_shares DROP CONSTRAINT bill_shares_user_id_bill_id_item_id_key;
+ALTER TABLE debts DROP CONSTRAINT debts_debtor_id_creditor_id_bill_id_key;
+ALTER TABLE bills DROP CONSTRAINT bills_pkey;
+
+ALTER TABLE bills RENAME id TO token;
+ALTER TABLE bills ALTER token SET NOT NULL;
+ALTER TABLE bills ADD CONSTRAINT bills_token_key
+UNIQUE USING INDEX bills_token_key;
+
+ALTER TABLE bills RENAME new_id TO id;
+ALTER TABLE bills ALTER id SET NOT NULL;
+ALTER TABLE bills ADD CONSTRAINT bills_pkey
+PRIMARY KEY USING INDEX bills_new_id_key;
+ALTER SEQUENCE bills_id_seq OWNED BY bills.id;
+
+ALTER TABLE items DROP bill_id;
+ALTER TABLE items RENAME bill_new_id TO bill_id;
+ALTER TABLE bill_taxes DROP bill_id;
+ALTER TABLE bill_taxes RENAME bill_new_id TO bill_id;
+ALTER TABLE bill_shares DROP bill_id;
+ALTER TABLE bill_shares RENAME bill_new_id TO bill_id;
+ALTER TABLE debts DROP bill_id;
+ALTER TABLE debts RENAME bill_new_id TO bill_id;
+
+ALTER TABLE bill_shares ADD CONSTRAINT bill_shares_user_id_bill_id_item_id_key
+UNIQUE USING INDEX bill_shares_user_id_bill_new_id_item_id_key;
+ALTER TABLE debts ADD CONSTRAINT debts_debtor_id_creditor_id_bill_id_key
+UNIQUE USING INDEX debts_debtor_id_creditor_id_bill_new_id_key;
+
+-- Checked for existing rows below, without blocking writes
+ALTER TABLE items ADD CONSTRAINT items_bill_id_fkey
+FOREIGN KEY (bill_id) REFERENCES bills(id) NOT VALID;
+ALTER TABLE bill_taxes ADD CONSTRAINT bill_taxes_bill_id_fkey
+FOREIGN KEY (bill_id) REFERENCES bills(id) NOT VALID;
+ALTER TABLE bill_shares ADD CONSTRAINT bill_shares_bill_id_fkey
+FOREIGN KEY (bill_id) REFERENCES bills(id) NOT VALID;
+ALTER TABLE debts ADD CONSTRAINT debts_bill_id_fkey
+FOREIGN KEY (bill_id) REFERENCES bills(id) NOT VALID;
+
+-- Sessions in progress refer to bills by the new id
+UPDATE sessions s
+SET data = jsonb_set(s.data::jsonb, '{b}', to_jsonb(b.id))::text
+FROM bills b
+WHERE s.data IS NOT NULL
+AND s.data::jsonb ->> 'b' = b.token;
+
+COMMIT;
+
+ALTER TABLE items VALIDATE CONSTRAINT items_bill_id_fkey;
+ALTER TABLE bill_taxes VALIDATE CONSTRAINT bill_taxes_bill_id_fkey;
+ALTER TABLE bill_shares VALIDATE CONSTRAINT bill_shares_bill_id_fkey;
+ALTER TABLE debts VALIDATE CONSTRAINT debts_bill_id_fkey;
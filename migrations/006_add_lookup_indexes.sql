@@ -0,0 +1,16 @@
+-- Indexes for the columns the bot filters, joins and orders by. Built
+-- CONCURRENTLY so that the bot keeps writing while they build; run this
+-- file outside of a transaction. If a build fails, DROP the INVALID index
+-- it leaves behind before running the file again.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS items_bill_id_created_at_idx
+ON items (bill_id, created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bill_taxes_bill_id_created_at_idx
+ON bill_taxes (bill_id, created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bill_shares_bill_id_created_at_idx
+ON bill_shares (bill_id, created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS debts_bill_id_creditor_id_debtor_id_idx
+ON debts (bill_id, creditor_id, debtor_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS payments_debt_id_idx
+ON payments (debt_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bills_owner_id_created_at_idx
+ON bills (owner_id, created_at DESC);
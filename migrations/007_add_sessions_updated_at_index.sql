@@ -0,0 +1,4 @@
+-- Lets the session reaper find idle sessions without scanning the table.
+-- CONCURRENTLY cannot run inside a transaction; apply this file on its own.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sessions_updated_at_idx
+ON sessions (updated_at);
@@ -0,0 +1,4 @@
+-- Lets the draft cleanup find bills never marked done, oldest first,
+-- without scanning the completed ones. Run outside of a transaction.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bills_draft_created_at_idx
+ON bills (created_at) WHERE completed_at IS NULL;
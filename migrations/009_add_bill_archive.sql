@@ -0,0 +1,47 @@
+-- Settled bills are moved, with everything that refers to them, into the
+-- archive schema, and moved back when someone opens them again.
+-- The archive tables must keep the same columns, in the same order, as
+-- the hot ones: a column added to a hot table has to be added to its
+-- archive table in the same migration.
+ALTER TABLE bills ADD restored_at TIMESTAMP WITH TIME ZONE;
+
+CREATE SCHEMA archive;
+
+CREATE TABLE archive.bills (LIKE public.bills);
+ALTER TABLE archive.bills ADD PRIMARY KEY (id);
+CREATE UNIQUE INDEX archive_bills_token_key ON archive.bills (token);
+CREATE INDEX archive_bills_owner_id_idx ON archive.bills (owner_id);
+
+CREATE TABLE archive.items (LIKE public.items);
+ALTER TABLE archive.items ADD PRIMARY KEY (id);
+CREATE INDEX archive_items_bill_id_idx ON archive.items (bill_id);
+
+CREATE TABLE archive.bill_taxes (LIKE public.bill_taxes);
+ALTER TABLE archive.bill_taxes ADD PRIMARY KEY (id);
+CREATE INDEX archive_bill_taxes_bill_id_idx ON archive.bill_taxes (bill_id);
+
+CREATE TABLE archive.bill_shares (LIKE public.bill_shares);
+ALTER TABLE archive.bill_shares ADD PRIMARY KEY (id);
+CREATE INDEX archive_bill_shares_bill_id_idx ON archive.bill_shares (bill_id);
+CREATE INDEX archive_bill_shares_user_id_idx ON archive.bill_shares (user_id);
+
+CREATE TABLE archive.debts (LIKE public.debts);
+ALTER TABLE archive.debts ADD PRIMARY KEY (id);
+CREATE INDEX archive_debts_bill_id_idx ON archive.debts (bill_id);
+
+CREATE TABLE archive.payments (LIKE public.payments);
+ALTER TABLE archive.payments ADD PRIMARY KEY (id);
+CREATE INDEX archive_payments_debt_id_idx ON archive.payments (debt_id);
+
+CREATE TABLE archive.payment_events (LIKE public.payment_events);
+ALTER TABLE archive.payment_events ADD PRIMARY KEY (id);
+CREATE INDEX archive_payment_events_debt_id_idx
+ON archive.payment_events (debt_id);
+
+CREATE TABLE archive.debt_balances (LIKE public.debt_balances);
+ALTER TABLE archive.debt_balances ADD PRIMARY KEY (debt_id);
+
+-- Lets the archiver find closed bills, least recently closed or restored
+-- first. Run outside of a transaction.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bills_archive_after_idx
+ON bills ((COALESCE(restored_at, closed_at))) WHERE closed_at IS NOT NULL;
@@ -0,0 +1,205 @@
+#!/bin/bash
+set -e
+
+# Prints EXPLAIN ANALYZE plans of the hot bill queries on a generated
+# dataset, without and with the indexes of
+# migrations/006_add_lookup_indexes.sql, against the dev db.
+# Usage: sh scripts/index_benchmark.sh [bills]
+# All changes, including the generated data, are rolled back at the end.
+
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+export BILLS=${1:-20000}
+export INDEX_MIGRATION=$DIR/../migrations/006_add_lookup_indexes.sql
+
+cd $DIR/../src
+python3 - <<'PYEOF'
+import os
+import re
+import time
+from settings import EnvSettings
+import database
+from database import Database, Transaction
+
+BILLS = int(os.environ['BILLS'])
+USERS = 1000
+# Generated users get ids at or below this, clear of real users
+USER_BASE = -1000000
+
+settings = EnvSettings()
+db = Database(
+    settings.DB_HOST,
+    settings.DB_NAME,
+    settings.DB_PORT,
+    settings.DB_USER,
+    settings.DB_PASS
+)
+
+
+def read_indexes(path):
+    """\
+    (name, CREATE INDEX statement) of every index in the migration,
+    without CONCURRENTLY, which cannot run inside a transaction.
+    """
+    with open(path) as f:
+        sql = f.read()
+    indexes = []
+    for stmt in re.findall(r'CREATE INDEX CONCURRENTLY[^;]+;', sql):
+        name = re.search(r'IF NOT EXISTS (\w+)', stmt).group(1)
+        indexes.append((name, stmt.replace(' CONCURRENTLY', '')))
+    return indexes
+
+
+def generate(cursor):
+    params = {'users': USERS, 'bills': BILLS, 'base': USER_BASE}
+    cursor.execute("""\
+        INSERT INTO users (id, first_name)
+        SELECT %(base)s - g, 'Bench ' || g
+        FROM generate_series(1, %(users)s) g;
+
+        INSERT INTO bills (token, title, owner_id, created_at,
+            completed_at, closed_at)
+        SELECT substr(md5(random()::text || g), 1, 16), 'Bench ' || g,
+            %(base)s - (1 + g %% %(users)s),
+            NOW() - g * INTERVAL '1 minute', NOW(), NOW()
+        FROM generate_series(1, %(bills)s) g;
+
+        CREATE TEMP TABLE bench_bills ON COMMIT DROP AS
+        SELECT b.id, b.owner_id, b.created_at FROM bills b
+        WHERE b.owner_id <= %(base)s - 1;
+
+        INSERT INTO items (bill_id, name, price, created_at)
+        SELECT b.id, 'Item ' || g, g, b.created_at + g * INTERVAL '1 second'
+        FROM bench_bills b
+        CROSS JOIN generate_series(1, 5) g;
+
+        INSERT INTO bill_taxes (bill_id, title, amount, created_at)
+        SELECT b.id, 'Tax', 7, b.created_at
+        FROM bench_bills b;
+
+        INSERT INTO bill_shares (user_id, bill_id, item_id, created_at)
+        SELECT %(base)s - (1 + (i.id + g) %% %(users)s), i.bill_id, i.id,
+            i.created_at
+        FROM items i
+        INNER JOIN bench_bills b ON b.id = i.bill_id
+        CROSS JOIN generate_series(1, 3) g;
+
+        INSERT INTO debts (debtor_id, creditor_id, bill_id, original_amt)
+        SELECT %(base)s - (1 + (b.id + g) %% %(users)s), b.owner_id, b.id, 10
+        FROM bench_bills b
+        CROSS JOIN generate_series(1, 3) g;
+
+        WITH p AS (
+            INSERT INTO payments (type, debt_id, amount)
+            SELECT 0, d.id, d.original_amt
+            FROM debts d
+            INNER JOIN bench_bills b ON b.id = d.bill_id
+            RETURNING id, debt_id
+        )
+        INSERT INTO payment_events (payment_id, debt_id, status,
+            pending_delta)
+        SELECT id, debt_id, 1, 1 FROM p;
+    """, params)
+
+    cursor.execute("""\
+        SELECT id, owner_id FROM bench_bills
+        ORDER BY id
+        OFFSET %s LIMIT 1
+    """, (BILLS // 2,))
+    return cursor.fetchone()
+
+
+def get_queries(bill_id, owner_id):
+    return [
+        ('get_bill_items', """\
+            SELECT i.id, i.name, i.price
+                FROM items i
+            WHERE i.bill_id = %s
+            ORDER BY i.created_at
+        """, (bill_id,)),
+        ('get_bill_taxes', """\
+            SELECT bt.id, bt.title, bt.amount
+                FROM bill_taxes bt
+            WHERE bt.bill_id = %s
+            ORDER BY bt.created_at
+        """, (bill_id,)),
+        ('get_sharers', """\
+            SELECT bs.item_id, u.id, u.username,
+                u.first_name, u.last_name
+            FROM bill_shares bs
+            INNER JOIN users u ON u.id = bs.user_id
+            WHERE bs.bill_id = %s
+            AND NOT bs.is_deleted
+            ORDER BY bs.created_at
+        """, (bill_id,)),
+        ('get_debts', """\
+            SELECT d.id, d.original_amt, d.debtor_id, d.creditor_id,
+                {}
+            FROM debts d
+            {}
+            WHERE d.bill_id = %s
+            AND d.is_deleted = FALSE
+            ORDER BY d.creditor_id, d.debtor_id
+        """.format(database.DEBT_PAID_AMOUNT, database.DEBT_BALANCE_JOIN),
+            (bill_id,)),
+        ('get_pending_payments', """\
+            SELECT p.id, p.amount, d.debtor_id
+            FROM debts d
+            INNER JOIN payments p ON p.debt_id = d.id
+            {}
+            WHERE d.bill_id = %s
+            AND d.creditor_id = %s
+            AND d.is_deleted = FALSE
+            AND s.status = 1
+        """.format(database.PAYMENT_STATUS_JOIN), (bill_id, owner_id)),
+        ('get_all_bill_details', """\
+            SELECT b.id, b.closed_at, b.token FROM bills b
+            WHERE b.completed_at IS NOT NULL
+            AND b.owner_id = %s
+            ORDER BY b.created_at DESC
+        """, (owner_id,)),
+    ]
+
+
+def explain(cursor, label, queries):
+    print('=' * 30, label, '=' * 30)
+    for name, query, params in queries:
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+        print('--', name)
+        for row in cursor.fetchall():
+            print(row[0])
+        print()
+
+
+indexes = read_indexes(os.environ['INDEX_MIGRATION'])
+conn = db.get_connection()
+with Transaction(conn) as trans:
+    cursor = trans.cursor
+    for name, __ in indexes:
+        cursor.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+    start = time.time()
+    bill_id, owner_id = generate(cursor)
+    cursor.execute('ANALYZE')
+    print('Generated {} bills in {:.1f}s\n'.format(
+        BILLS, time.time() - start
+    ))
+
+    queries = get_queries(bill_id, owner_id)
+    explain(cursor, 'without indexes', queries)
+
+    for __, stmt in indexes:
+        cursor.execute(stmt)
+    # An index built over rows updated earlier in this transaction is not
+    # usable until the transaction ends, which would leave its plans as is
+    cursor.execute("""\
+        SELECT indexrelid::regclass FROM pg_index
+        WHERE indcheckxmin
+        AND indexrelid::regclass::text = ANY(%s)
+    """, ([name for name, __ in indexes],))
+    for row in cursor.fetchall():
+        print('Warning: {} cannot be used by this run\n'.format(row[0]))
+    cursor.execute('ANALYZE')
+    explain(cursor, 'with indexes', queries)
+
+    trans.is_error = True
+PYEOF
@@ -0,0 +1,86 @@
+#!/bin/bash
+set -e
+
+# Times the hot Transaction queries against the dev db, comparing plain
+# statements with the per-connection prepared statements.
+# Usage: sh scripts/query_benchmark.sh [iterations]
+# Every round runs in its own transaction, which is rolled back.
+
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+export ITERATIONS=${1:-1000}
+
+cd $DIR/../src
+python3 - <<'PYEOF'
+import os
+import time
+from settings import EnvSettings
+from database import Database, Transaction
+
+ITERATIONS = int(os.environ['ITERATIONS'])
+USER_ID = -999999
+ROUND_SIZE = 100
+
+settings = EnvSettings()
+db = Database(
+    settings.DB_HOST,
+    settings.DB_NAME,
+    settings.DB_PORT,
+    settings.DB_USER,
+    settings.DB_PASS
+)
+
+
+def run_hot_path(trans, bill_id, item_id):
+    trans.get_bill_gen_info(bill_id)
+    trans.get_bill_items(bill_id)
+    trans.get_sharers(bill_id)
+    trans.has_bill_share(bill_id, item_id, USER_ID)
+    trans.toggle_bill_share(bill_id, item_id, USER_ID)
+    trans.add_session(0, USER_ID, 0, 0, 0, None)
+    trans.get_session(0, USER_ID)
+
+
+def unprepared(trans):
+    def execute_prepared(name, query, params):
+        for i in range(len(params), 0, -1):
+            query = query.replace('${}'.format(i), '%s')
+        trans.cursor.execute(query, params)
+    return execute_prepared
+
+
+def run_round(label, iterations):
+    """\
+    Runs the hot path in a transaction of its own, which is rolled back so
+    the rows churned by toggle_bill_share never pile up across rounds.
+    """
+    with Transaction(db.get_connection()) as trans:
+        if label == 'plain':
+            trans.execute_prepared = unprepared(trans)
+        trans.add_user(USER_ID, 'Benchmark', None, None)
+        bill_id = trans.add_bill('Benchmark', USER_ID)
+        for i in range(20):
+            trans.add_item(bill_id, 'Item {}'.format(i), 1.0)
+        item_id = trans.get_bill_items(bill_id)[0][0]
+
+        start = time.time()
+        for __ in range(iterations):
+            run_hot_path(trans, bill_id, item_id)
+        elapsed = time.time() - start
+
+        trans.is_error = True
+    return elapsed
+
+
+# Short rounds, alternating which statements go first
+elapsed = {'plain': 0, 'prepared': 0}
+rounds = max(ITERATIONS // ROUND_SIZE, 1)
+for i in range(rounds):
+    labels = ('plain', 'prepared') if i % 2 == 0 else ('prepared', 'plain')
+    for label in labels:
+        elapsed[label] += run_round(label, ITERATIONS // rounds)
+
+for label in ('plain', 'prepared'):
+    print('{:>8}: {:.3f}s total, {:.3f}ms per hot path'.format(
+        label, elapsed[label], elapsed[label] * 1000 / ITERATIONS
+    ))
+PYEOF
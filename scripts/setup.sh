@@ -36,6 +36,7 @@ cp $DIR/../.env $DIR/../web.env
 echo "DB_HOST=db" >> $DIR/../web.env
 echo "DB_NAME=whopay" >> $DIR/../web.env
 echo "DB_PORT=5432" >> $DIR/../web.env
+echo "CACHE_URL=redis://cache:6379/0" >> $DIR/../web.env
 
 if [ -f $DIR/../db.env ]
   then
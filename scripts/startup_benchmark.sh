@@ -0,0 +1,34 @@
+#!/bin/bash
+set -e
+
+# Measures how long it takes to import the bot's startup modules and fails
+# if any part of the OCR stack gets imported on the text path.
+# Pass a python executable as the first argument to override python3.
+
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+PYTHON=${1:-python3}
+
+cd $DIR/../src
+$PYTHON - <<'PYEOF'
+import sys
+import time
+
+start = time.time()
+import main
+import telegrambot
+elapsed = time.time() - start
+
+from ocr_loader import OCR_MODULES
+loaded = [m for m in OCR_MODULES if m in sys.modules]
+
+print("Startup imports took {:.3f}s".format(elapsed))
+if len(loaded) > 0:
+    print("OCR modules imported at startup: {}".format(', '.join(loaded)))
+    sys.exit(1)
+print("No OCR modules imported at startup")
+PYEOF
+
+# Per-module breakdown, slowest first
+$PYTHON -X importtime -c "import main, telegrambot" 2>&1 \
+    | sort -t '|' -k 2 -n -r \
+    | head -n 15
@@ -312,6 +312,38 @@ def evaluate_text_area(text_area, results):
             results.put(result)
 
 
+def read_receipt(image):
+    """\
+    Returns the upright image and a list of (text, box) tuples, one for
+    each line of text detected on the receipt.
+    """
+    image = rotate_to_upright(image)
+    original = np.array(image)
+
+    binarised = binarise_image(original)
+
+    text_areas = extract_text_areas(binarised, original)
+
+    results = Queue()
+    processes = []
+    for text_area in text_areas:
+        process = Process(
+            target=evaluate_text_area,
+            args=(text_area, results)
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+    detected = []
+    while not results.empty():
+        detected.append(results.get())
+
+    return image, detected
+
+
 if __name__ == '__main__':
     if len(sys.argv) != 2:
         print("Incorrect number of arguments '{}' given.".format(len(sys.argv) - 1))
@@ -319,37 +351,14 @@ if __name__ == '__main__':
         sys.exit()
 
     img_path = sys.argv[1]
-    image = Image.open(img_path)
-    image = rotate_to_upright(image)
-
-    with PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, lang='eng') as api:
-        api.SetImage(image)
-        original = np.array(image)
+    image, results = read_receipt(Image.open(img_path))
 
-        binarised = binarise_image(original)
+    for text, box in results:
+        draw = ImageDraw.Draw(image)
+        font = ImageFont.truetype('DejaVuSans-Bold.ttf', 32)
+        points = list(map(tuple, box))
+        points.append(tuple(box[0]))
+        draw.line(points, width=5, fill=(0, 255, 0))
+        draw.text(points[0], text, (255, 0, 0), font=font)
 
-        text_areas = extract_text_areas(binarised, original)
-
-        results = Queue()
-        processes = []
-        for text_area in text_areas:
-            process = Process(
-                target=evaluate_text_area,
-                args=(text_area, results)
-            )
-            process.start()
-            processes.append(process)
-
-        for process in processes:
-            process.join()
-
-        while not results.empty():
-            text, box = results.get()
-            draw = ImageDraw.Draw(image)
-            font = ImageFont.truetype('DejaVuSans-Bold.ttf', 32)
-            points = list(map(tuple, box))
-            points.append(tuple(box[0]))
-            draw.line(points, width=5, fill=(0, 255, 0))
-            draw.text(points[0], text, (255, 0, 0), font=font)
-
-        image.save('result.jpg')
+    image.save('result.jpg')
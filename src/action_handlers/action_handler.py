@@ -1,29 +1,91 @@
+class ActionRegistry:
+    """\
+    Maps (action_type, action_id) to preconstructed, stateless actions so
+    that dispatching an update is a single dict lookup.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.actions = {}
+
+    def register_handler(self, handler):
+        self.handlers[handler.action_type] = handler
+        for action in handler.actions.values():
+            self.actions[(action.action_type, action.action_id)] = action
+        return handler
+
+    def get_handler(self, action_type):
+        handler = self.handlers.get(action_type)
+        if handler is None:
+            raise Exception("Action type '{}' unknown".format(action_type))
+        return handler
+
+    def get_action(self, action_type, action_id):
+        return self.actions.get((action_type, action_id))
+
+    def get_action_name(self, action_type, action_id):
+        action = self.get_action(action_type, action_id)
+        if action is None:
+            return 'Unknown({}, {})'.format(action_type, action_id)
+        return action.name
+
+    def __iter__(self):
+        return iter(self.actions.items())
+
+
+registry = ActionRegistry()
+
+
 class ActionHandler:
-    def __init__(self, action_type):
+    def __init__(self, action_type, actions=()):
         self.action_type = action_type
+        self.actions = {}
+        for action in actions:
+            self.actions[action.action_id] = action
+
+    def get_action(self, action_id):
+        return self.actions.get(action_id)
 
     def execute(self, bot, update, trans, action_id,
                 subaction_id=0, data=None):
-        pass
+        action = self.get_action(action_id)
+        if action is None:
+            return
+        return action.execute(bot, update, trans, subaction_id, data)
 
     def execute_done(self, bot, update, trans, action_id,
                      subaction_id=0, data=None):
-        pass
+        action = self.get_action(action_id)
+        if action is None:
+            return
+        return action.done(bot, update, trans, subaction_id, data)
 
     def execute_yes(self, bot, update, trans, action_id,
                     subaction_id=0, data=None):
-        pass
+        action = self.get_action(action_id)
+        if action is None:
+            return
+        return action.yes(bot, update, trans, subaction_id, data)
 
     def execute_no(self, bot, update, trans, action_id,
                    subaction_id=0, data=None):
-        pass
+        action = self.get_action(action_id)
+        if action is None:
+            return
+        return action.no(bot, update, trans, subaction_id, data)
 
 
 class Action:
+    # Read-only actions run in a lock-free READ ONLY snapshot transaction
+    read_only = False
+
     def __init__(self, action_type, action_id):
         self.action_type = action_type
         self.action_id = action_id
 
+    @property
+    def name(self):
+        return type(self).__name__
+
     def execute(self, bot, update, trans, subaction_id, data=None):
         pass
 
@@ -3,7 +3,7 @@ from telegram.inlinekeyboardmarkup import InlineKeyboardMarkup
 from telegram.inlinekeyboardbutton import InlineKeyboardButton
 from telegram.parsemode import ParseMode
 
-from action_handlers.action_handler import ActionHandler, Action
+from action_handlers.action_handler import ActionHandler, Action, registry
 from action_handlers import manage_bill_handler
 import constants as const
 import utils
@@ -54,7 +54,27 @@ class BillCreationHandler(ActionHandler):
     """docstring for NewBillHandler"""
 
     def __init__(self):
-        super().__init__(MODULE_ACTION_TYPE)
+        super().__init__(MODULE_ACTION_TYPE, (
+            CreateNewBill(),
+            DisplayNewBillKB(),
+            DisplayModifyItemsKB(),
+            DisplayModifyTaxesKB(),
+            DisplayEditItemsKB(),
+            DisplayEditSpecificItemKB(),
+            DisplayDeleteItemsKB(),
+            DisplayEditTaxesKB(),
+            DisplayEditSpecificTaxKB(),
+            DisplayDeleteTaxesKB(),
+            AddItems(),
+            EditItemName(),
+            EditItemPrice(),
+            DeleteItem(),
+            AddTax(),
+            EditTaxName(),
+            EditTaxAmt(),
+            DeleteTax(),
+            CreateBillDone(),
+        ))
 
     def evaluate_rights(self, update, trans, data):
         if data is None:
@@ -97,63 +117,9 @@ class BillCreationHandler(ActionHandler):
                 )
             return
 
-        action = None
-        if action_id == ACTION_NEW_BILL:
-            action = CreateNewBill()
-        if action_id == ACTION_GET_NEW_BILL_KB:
-            action = DisplayNewBillKB()
-        if action_id == ACTION_GET_MODIFY_ITEMS_KB:
-            action = DisplayModifyItemsKB()
-        if action_id == ACTION_GET_MODIFY_TAXES_KB:
-            action = DisplayModifyTaxesKB()
-        if action_id == ACTION_GET_EDIT_ITEM_KB:
-            action = DisplayEditItemsKB()
-        if action_id == ACTION_GET_EDIT_SPECIFIC_ITEM_KB:
-            action = DisplayEditSpecificItemKB()
-        if action_id == ACTION_GET_DELETE_ITEM_KB:
-            action = DisplayDeleteItemsKB()
-        if action_id == ACTION_GET_EDIT_TAX_KB:
-            action = DisplayEditTaxesKB()
-        if action_id == ACTION_GET_EDIT_SPECIFIC_TAX_KB:
-            action = DisplayEditSpecificTaxKB()
-        if action_id == ACTION_GET_DELETE_TAX_KB:
-            action = DisplayDeleteTaxesKB()
-        if action_id == ACTION_ADD_ITEMS:
-            action = AddItems()
-        if action_id == ACTION_EDIT_SPECIFIC_ITEM_NAME:
-            action = EditItemName()
-        if action_id == ACTION_EDIT_SPECIFIC_ITEM_PRICE:
-            action = EditItemPrice()
-        if action_id == ACTION_DELETE_SPECIFIC_ITEM:
-            action = DeleteItem()
-        if action_id == ACTION_ADD_TAX:
-            action = AddTax()
-        if action_id == ACTION_EDIT_SPECIFIC_TAX_NAME:
-            action = EditTaxName()
-        if action_id == ACTION_EDIT_SPECIFIC_TAX_AMT:
-            action = EditTaxAmt()
-        if action_id == ACTION_DELETE_SPECIFIC_TAX:
-            action = DeleteTax()
-        if action_id == ACTION_CREATE_BILL_DONE:
-            action = CreateBillDone()
-
-        if action is None:
-            return
-
-        action.execute(bot, update, trans, subaction_id, data)
-
-    def execute_done(self, bot, update, trans, action_id,
-                     subaction_id=0, data=None):
-        action = None
-        if action_id == ACTION_ADD_ITEMS:
-            action = AddItems()
-        if action_id == ACTION_ADD_TAX:
-            action = AddTax()
-
-        if action is None:
-            return
-
-        action.done(bot, update, trans, subaction_id, data)
+        return super().execute(
+            bot, update, trans, action_id, subaction_id, data
+        )
 
 
 class CreateNewBill(Action):
@@ -226,6 +192,7 @@ class CreateNewBill(Action):
 
 class DisplayNewBillKB(Action):
     ACTION_DISPLAY_NEW_BILL_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_NEW_BILL_KB)
@@ -273,6 +240,7 @@ class DisplayNewBillKB(Action):
 
 class DisplayModifyItemsKB(Action):
     ACTION_DISPLAY_MODIFY_ITEMS_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_MODIFY_ITEMS_KB)
@@ -329,6 +297,7 @@ class DisplayModifyItemsKB(Action):
 
 class DisplayModifyTaxesKB(Action):
     ACTION_DISPLAY_MODIFY_TAXES_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_MODIFY_TAXES_KB)
@@ -385,6 +354,7 @@ class DisplayModifyTaxesKB(Action):
 
 class DisplayEditItemsKB(Action):
     ACTION_DISPLAY_EDIT_ITEMS_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_EDIT_ITEM_KB)
@@ -414,6 +384,7 @@ class DisplayEditItemsKB(Action):
 
 class DisplayEditSpecificItemKB(Action):
     ACTION_DISPLAY_EDIT_SPECIFIC_ITEM_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_EDIT_SPECIFIC_ITEM_KB)
@@ -469,6 +440,7 @@ class DisplayEditSpecificItemKB(Action):
 
 class DisplayDeleteItemsKB(Action):
     ACTION_DISPLAY_DELETE_ITEMS_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_DELETE_ITEM_KB)
@@ -498,6 +470,7 @@ class DisplayDeleteItemsKB(Action):
 
 class DisplayEditTaxesKB(Action):
     ACTION_DISPLAY_EDIT_TAXES_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_EDIT_TAX_KB)
@@ -527,6 +500,7 @@ class DisplayEditTaxesKB(Action):
 
 class DisplayEditSpecificTaxKB(Action):
     ACTION_DISPLAY_EDIT_SPECIFIC_TAX_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_EDIT_SPECIFIC_TAX_KB)
@@ -582,6 +556,7 @@ class DisplayEditSpecificTaxKB(Action):
 
 class DisplayDeleteTaxesKB(Action):
     ACTION_DISPLAY_DELETE_TAXES_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_DELETE_TAX_KB)
@@ -1274,7 +1249,7 @@ class CreateBillDone(Action):
         bill_id = data.get(const.JSON_BILL_ID)
         cbq = update.callback_query
         trans.set_bill_done(bill_id, cbq.from_user.id)
-        manage_bill_handler.BillManagementHandler().execute(
+        registry.get_handler(const.TYPE_MANAGE_BILL).execute(
             bot,
             update,
             trans,
@@ -1370,3 +1345,6 @@ def get_tax_buttons(bill_id, action, trans):
         keyboard.append([tax_btn])
 
     return keyboard
+
+
+registry.register_handler(BillCreationHandler())
@@ -1,9 +1,10 @@
-from action_handlers.action_handler import ActionHandler, Action
+from action_handlers.action_handler import ActionHandler, Action, registry
 from telegram.inlinekeyboardmarkup import InlineKeyboardMarkup
 from telegram.inlinekeyboardbutton import InlineKeyboardButton
 from telegram.ext import Filters
 from telegram.parsemode import ParseMode
 from telegram.error import BadRequest
+from cache import payment_selections
 import constants as const
 import utils
 import datetime
@@ -33,11 +34,16 @@ ACTION_GET_INSPECT_BILL_KB = 15
 ACTION_GET_FORCE_CONFIRM_PAYMENTS_KB = 16
 ACTION_FORCE_CONFIRM_PAYMENT = 17
 ACTION_ADD_SOMEONE = 18
+ACTION_SELECT_PAYMENT = 19
+ACTION_CONFIRM_SELECTED_PAYMENTS = 20
+ACTION_CONFIRM_ALL_PAYMENTS = 21
 
 ERROR_ITEMS_NOT_SHARED = "The bill cannot be split because the following items are not shared:\n{}"
 REQUEST_CALC_SPLIT_CONFIRMATION = "You are about to calculate the splitting of the bill. Once this is done, no new person can be added to the bill anymore. Do you wish to continue? Reply /yes or /no."
 ERROR_INVALID_CONTACT = "Sorry, invalid Contact or name sent. Name can only be 250 characters long. Please try again."
 REQUEST_PAY_CONFIRMATION = "You are about to confirm <b>{}'s</b> payment of {}{:.2f}. This action is irreversible. Do you wish to continue? Reply /yes or /no."
+REQUEST_PAYMENTS_CONFIRMATION = "You are about to confirm the payments of:\n{}\nThis action is irreversible. Do you wish to continue? Reply /yes or /no."
+ERROR_NO_PAYMENTS_SELECTED = "No pending payments selected"
 REQUEST_FORCE_PAY_CONFIRMATION = "You are about to forcibly confirm <b>{}'s</b> payment of {}{:.2f}. This person has not indicated payment yet. This action is irreversible. Do you wish to continue? Reply /yes or /no."
 REQUEST_CONTACT = "Please send me the <b>Contact</b> or name of the person. However, this person might <b>not</b> be able to indicate payment for this bill later on. You will have to force confirm his/her payment. To stop this, reply /no."
 YES_WITH_QUOTES = "'yes'"
@@ -48,67 +54,25 @@ NO = 'no'
 
 class BillManagementHandler(ActionHandler):
     def __init__(self):
-        super().__init__(MODULE_ACTION_TYPE)
-
-    def execute(self, bot, update, trans, action_id,
-                subaction_id=0, data=None):
-        action = None
-        if action_id == ACTION_SEND_BILL:
-            action = SendBill()
-        if action_id == ACTION_GET_MANAGE_BILL:
-            action = SendCompleteBill()
-        if action_id == ACTION_REFRESH_BILL:
-            action = RefreshBill()
-        if action_id == ACTION_CALCULATE_SPLIT:
-            action = CalculateBillSplit()
-        if action_id == ACTION_GET_CONFIRM_PAYMENTS_KB:
-            action = DisplayConfirmPaymentsKB()
-        if action_id == ACTION_CONFIRM_BILL_PAYMENT:
-            action = ConfirmPayment()
-        if action_id == ACTION_SHARE_BILL_ITEM:
-            action = ShareBillItem()
-        if action_id == ACTION_SHARE_ALL_ITEMS:
-            action = ShareAllItems()
-        if action_id == ACTION_GET_MANAGE_BILL_KB:
-            action = DisplayManageBillKB()
-        if action_id == ACTION_GET_SHARE_ITEMS_KB:
-            action = DisplayShareItemsKB()
-        if action_id == ACTION_PAY_DEBT:
-            action = PayDebt()
-        if action_id == ACTION_FORCE_CONFIRM_PAYMENT:
-            action = ForceConfirmPayment()
-        if action_id == ACTION_GET_FORCE_CONFIRM_PAYMENTS_KB:
-            action = DisplayForceConfirmPaymentsKB()
-        if action_id == ACTION_ADD_SOMEONE:
-            action = AddSomeone()
-
-        action.execute(bot, update, trans, subaction_id, data)
-
-    def execute_yes(self, bot, update, trans, action_id,
-                    subaction_id=0, data=None):
-        action = None
-        if action_id == ACTION_CONFIRM_BILL_PAYMENT:
-            action = ConfirmPayment()
-        if action_id == ACTION_CALCULATE_SPLIT:
-            action = CalculateBillSplit()
-        if action_id == ACTION_FORCE_CONFIRM_PAYMENT:
-            action = ForceConfirmPayment()
-
-        action.yes(bot, update, trans, subaction_id, data)
-
-    def execute_no(self, bot, update, trans, action_id,
-                   subaction_id=0, data=None):
-        action = None
-        if action_id == ACTION_CONFIRM_BILL_PAYMENT:
-            action = ConfirmPayment()
-        if action_id == ACTION_CALCULATE_SPLIT:
-            action = CalculateBillSplit()
-        if action_id == ACTION_FORCE_CONFIRM_PAYMENT:
-            action = ForceConfirmPayment()
-        if action_id == ACTION_ADD_SOMEONE:
-            action = AddSomeone()
-
-        action.no(bot, update, trans, subaction_id, data)
+        super().__init__(MODULE_ACTION_TYPE, (
+            SendBill(),
+            SendCompleteBill(),
+            RefreshBill(),
+            CalculateBillSplit(),
+            DisplayConfirmPaymentsKB(),
+            ConfirmPayment(),
+            ShareBillItem(),
+            ShareAllItems(),
+            DisplayManageBillKB(),
+            DisplayShareItemsKB(),
+            PayDebt(),
+            ForceConfirmPayment(),
+            DisplayForceConfirmPaymentsKB(),
+            AddSomeone(),
+            SelectPayment(),
+            ConfirmSelectedPayments(),
+            ConfirmAllPayments(),
+        ))
 
 
 class SendBill(Action):
@@ -187,6 +151,7 @@ class SendCompleteBill(Action):
 
 class DisplayManageBillKB(Action):
     ACTION_DISPLAY_NEW_BILL_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_MANAGE_BILL_KB)
@@ -259,6 +224,7 @@ class DisplayManageBillKB(Action):
 
 class DisplayShareItemsKB(Action):
     ACTION_DISPLAY_SHARE_ITEMS_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_SHARE_ITEMS_KB)
@@ -596,6 +562,7 @@ class ShareAllItems(Action):
 
 class RefreshBill(Action):
     ACTION_REFRESH_BILL = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_REFRESH_BILL)
@@ -605,12 +572,40 @@ class RefreshBill(Action):
             bill_id = data.get(const.JSON_BILL_ID)
             __, __, __, closed_at = trans.get_bill_gen_info(bill_id)
             if closed_at is None:
-                return SendCompleteBill().execute(
-                    bot, update, trans, data=data
-                )
+                return self.refresh_bill(update, trans, data)
             else:
                 return self.refresh_debts_bill(update, trans, data)
 
+    def refresh_bill(self, update, trans, data):
+        try:
+            cbq = update.callback_query
+            chat_id = cbq.message.chat_id
+            bill_id = data.get(const.JSON_BILL_ID)
+            # Refreshing cancels a pending action, such as a split
+            # waiting for confirmation, which takes a write
+            act_type, __, __, __ = trans.get_session(
+                chat_id, cbq.from_user.id
+            )
+            if act_type is not None:
+                if trans.read_only:
+                    trans.needs_write = True
+                    return
+                trans.reset_session(chat_id, cbq.from_user.id)
+
+            text, pm, kb = SendCompleteBill.get_appropriate_response(
+                bill_id, cbq.from_user.id, trans
+            )
+            cbq.answer()
+            cbq.edit_message_text(
+                text=text,
+                parse_mode=pm,
+                reply_markup=kb
+            )
+        except BadRequest as e:
+            logging.warning('RefreshBill: {}'.format(e))
+        except Exception as e:
+            logging.exception('RefreshBill')
+
     def refresh_debts_bill(self, update, trans, data):
         try:
             cbq = update.callback_query
@@ -761,19 +756,12 @@ class CalculateBillSplit(Action):
                     else:
                         debtors[sharer] += amt_to_pay / 100
 
-            trans.add_debtors(bill_id, bill['owner_id'], debtors)
-            trans.close_bill(bill_id)
-            for debtor_id, amt in debtors.items():
-                auto_confirm = debtor_id == bill['owner_id']
-                is_deleted = debtor_id != bill['owner_id']
-                trans.add_payment_by_bill(
-                    const.PAY_TYPE_NORMAL,
-                    bill_id,
-                    bill['owner_id'],
-                    debtor_id,
-                    auto_confirm=auto_confirm,
-                    is_deleted=is_deleted
-                )
+            trans.close_bill_with_debtors(
+                bill_id,
+                bill['owner_id'],
+                debtors,
+                const.PAY_TYPE_NORMAL
+            )
             return SendDebtsBillAdmin().execute(bot, update, trans, data=data)
         except Exception as e:
             logging.exception('split_bill')
@@ -829,6 +817,7 @@ class DisplayInspectBillKB(Action):
 
 class DisplayConfirmPaymentsKB(Action):
     ACTION_DISPLAY_PAYMENTS_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_GET_CONFIRM_PAYMENTS_KB)
@@ -840,31 +829,66 @@ class DisplayConfirmPaymentsKB(Action):
             creditor_id = cbq.from_user.id
             return cbq.edit_message_reply_markup(
                 reply_markup=self.get_confirm_payments_keyboard(
-                    bill_id, creditor_id, trans
+                    bill_id, creditor_id, cbq.message.chat_id, trans
                 )
             )
 
     @staticmethod
-    def get_confirm_payments_keyboard(bill_id, creditor_id, trans):
+    def get_selection_key(chat_id, creditor_id, bill_id):
+        return chat_id, creditor_id, bill_id
+
+    @staticmethod
+    def get_confirm_payments_keyboard(bill_id, creditor_id, chat_id, trans):
         pending = trans.get_pending_payments(bill_id, creditor_id)
+        selected = payment_selections.get(
+            DisplayConfirmPaymentsKB.get_selection_key(
+                chat_id, creditor_id, bill_id
+            )
+        )
 
         kb = []
+        num_selected = 0
         for payment in pending:
+            is_selected = payment[0] in selected
+            if is_selected:
+                num_selected += 1
             btn = InlineKeyboardButton(
-                text='✅ {}  {}{:.2f}'.format(
+                text='{} {}  {}{:.2f}'.format(
+                    '☑️' if is_selected else '⬜',
                     utils.format_name(payment[5], payment[3], payment[4]),
                     const.EMOJI_MONEY_BAG,
                     payment[1],
                 ),
                 callback_data=utils.get_action_callback_data(
                     MODULE_ACTION_TYPE,
-                    ACTION_CONFIRM_BILL_PAYMENT,
+                    ACTION_SELECT_PAYMENT,
                     {const.JSON_BILL_ID: bill_id,
                      const.JSON_PAYMENT_ID: payment[0]}
                 )
             )
             kb.append([btn])
 
+        if num_selected > 0:
+            confirm_selected_btn = InlineKeyboardButton(
+                text="✅ Confirm Selected ({})".format(num_selected),
+                callback_data=utils.get_action_callback_data(
+                    MODULE_ACTION_TYPE,
+                    ACTION_CONFIRM_SELECTED_PAYMENTS,
+                    {const.JSON_BILL_ID: bill_id}
+                )
+            )
+            kb.append([confirm_selected_btn])
+        if len(pending) > 0:
+            confirm_all_btn = InlineKeyboardButton(
+                text="✅ Confirm All ({})".format(len(pending)),
+                callback_data=utils.get_action_callback_data(
+                    MODULE_ACTION_TYPE,
+                    ACTION_CONFIRM_ALL_PAYMENTS,
+                    {const.JSON_BILL_ID: bill_id}
+                )
+            )
+            kb.append([confirm_all_btn])
+
         back_btn = InlineKeyboardButton(
             text="🔙 Back",
             callback_data=utils.get_action_callback_data(
@@ -877,8 +901,35 @@ class DisplayConfirmPaymentsKB(Action):
         return InlineKeyboardMarkup(kb)
 
 
+class SelectPayment(Action):
+    ACTION_SELECT_PAYMENT = 0
+    read_only = True
+
+    def __init__(self):
+        super().__init__(MODULE_ACTION_TYPE, ACTION_SELECT_PAYMENT)
+
+    def execute(self, bot, update, trans, subaction_id, data=None):
+        if subaction_id == self.ACTION_SELECT_PAYMENT:
+            cbq = update.callback_query
+            bill_id = data.get(const.JSON_BILL_ID)
+            payment_id = data.get(const.JSON_PAYMENT_ID)
+            creditor_id = cbq.from_user.id
+            chat_id = cbq.message.chat_id
+            payment_selections.toggle(
+                DisplayConfirmPaymentsKB.get_selection_key(
+                    chat_id, creditor_id, bill_id
+                ),
+                payment_id
+            )
+            kb = DisplayConfirmPaymentsKB.get_confirm_payments_keyboard(
+                bill_id, creditor_id, chat_id, trans
+            )
+            return cbq.edit_message_reply_markup(reply_markup=kb)
+
+
 class DisplayForceConfirmPaymentsKB(Action):
     ACTION_DISPLAY_PAYMENTS_KB = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(
@@ -1115,7 +1166,92 @@ class ConfirmPayment(Action):
         trans.confirm_payment(payment_id)
         text, pm = utils.get_debts_bill_text(bill_id, trans)
         kb = DisplayConfirmPaymentsKB.get_confirm_payments_keyboard(
-            bill_id, msg.from_user.id, trans
+            bill_id, msg.from_user.id, msg.chat_id, trans
+        )
+        trans.reset_session(msg.chat_id, msg.from_user.id)
+        bot.sendMessage(
+            chat_id=msg.chat_id,
+            text=text,
+            parse_mode=pm,
+            reply_markup=kb
+        )
+
+
+class ConfirmSelectedPayments(Action):
+    ACTION_REQUEST_CONFIRMATION = 0
+    confirm_all = False
+
+    def __init__(self, action_id=ACTION_CONFIRM_SELECTED_PAYMENTS):
+        super().__init__(MODULE_ACTION_TYPE, action_id)
+
+    def execute(self, bot, update, trans, subaction_id=0, data=None):
+        if subaction_id == self.ACTION_REQUEST_CONFIRMATION:
+            cbq = update.callback_query
+            bill_id = data.get(const.JSON_BILL_ID)
+            return self.send_confirmation(bot, cbq, bill_id, trans)
+
+    def send_confirmation(self, bot, cbq, bill_id, trans):
+        creditor_id = cbq.from_user.id
+        chat_id = cbq.message.chat_id
+        pending = trans.get_pending_payments(bill_id, creditor_id)
+        if not self.confirm_all:
+            selected = payment_selections.get(
+                DisplayConfirmPaymentsKB.get_selection_key(
+                    chat_id, creditor_id, bill_id
+                )
+            )
+            pending = [p for p in pending if p[0] in selected]
+
+        if len(pending) < 1:
+            return cbq.answer(text=ERROR_NO_PAYMENTS_SELECTED)
+
+        # The payments listed are the ones confirmed on /yes
+        self.set_session(
+            chat_id,
+            cbq.from_user,
+            self.action_type,
+            self.action_id,
+            0,
+            trans,
+            data={const.JSON_BILL_ID: bill_id,
+                  const.JSON_PAYMENT_IDS: [p[0] for p in pending]}
+        )
+        payments_text = ''
+        for __, amt, __, fname, lname, uname in pending:
+            payments_text += '<b>{}</b>  {}{:.2f}\n'.format(
+                utils.escape_html(
+                    utils.format_name(uname, fname, lname)
+                ),
+                const.EMOJI_MONEY_BAG,
+                amt
+            )
+        cbq.answer()
+        bot.sendMessage(
+            chat_id=chat_id,
+            text=REQUEST_PAYMENTS_CONFIRMATION.format(payments_text),
+            parse_mode=ParseMode.HTML
+        )
+
+    def yes(self, bot, update, trans, subaction_id, data=None):
+        bill_id = data.get(const.JSON_BILL_ID)
+        payment_ids = data.get(const.JSON_PAYMENT_IDS, [])
+        self.confirm_payments(
+            bot, bill_id, payment_ids, update.message, trans
+        )
+
+    def no(self, bot, update, trans, subaction_id, data=None):
+        return SendDebtsBill().execute(bot, update, trans, 0, data)
+
+    def confirm_payments(self, bot, bill_id, payment_ids, msg, trans):
+        trans.confirm_payments(bill_id, msg.from_user.id, payment_ids)
+        payment_selections.clear(
+            DisplayConfirmPaymentsKB.get_selection_key(
+                msg.chat_id, msg.from_user.id, bill_id
+            )
+        )
+        text, pm = utils.get_debts_bill_text(bill_id, trans)
+        kb = DisplayConfirmPaymentsKB.get_confirm_payments_keyboard(
+            bill_id, msg.from_user.id, msg.chat_id, trans
         )
         trans.reset_session(msg.chat_id, msg.from_user.id)
         bot.sendMessage(
@@ -1126,6 +1262,13 @@ class ConfirmPayment(Action):
         )
 
 
+class ConfirmAllPayments(ConfirmSelectedPayments):
+    confirm_all = True
+
+    def __init__(self):
+        super().__init__(ACTION_CONFIRM_ALL_PAYMENTS)
+
+
 class ForceConfirmPayment(Action):
     ACTION_REQUEST_CONFIRMATION = 0
 
@@ -1311,3 +1454,6 @@ def evaluate_rights(update, trans, data):
         return False, chat_id, 'Sorry, bill is already calculated and closed.'
 
     return True, None, None
+
+
+registry.register_handler(BillManagementHandler())
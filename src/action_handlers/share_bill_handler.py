@@ -1,9 +1,10 @@
-from action_handlers.action_handler import ActionHandler, Action
+from action_handlers.action_handler import ActionHandler, Action, registry
 from telegram import InlineQueryResultArticle, InputTextMessageContent
 from telegram.inlinekeyboardmarkup import InlineKeyboardMarkup
 from telegram.inlinekeyboardbutton import InlineKeyboardButton
 from settings import EnvSettings
 import constants as const
+from cache import render_cache
 import utils
 
 MODULE_ACTION_TYPE = const.TYPE_SHARE_BILL
@@ -14,20 +15,16 @@ ACTION_REFRESH_SHARE_BILL = 1
 
 class BillShareHandler(ActionHandler):
     def __init__(self):
-        super().__init__(MODULE_ACTION_TYPE)
-
-    def execute(self, bot, update, trans, action_id,
-                subaction_id=0, data=None):
-        action = None
-        if action_id == ACTION_FIND_BILLS:
-            action = FindBills()
-        if action_id == ACTION_REFRESH_SHARE_BILL:
-            action = RefreshShareBill()
-        action.execute(bot, update, trans, subaction_id, data)
+        super().__init__(MODULE_ACTION_TYPE, (
+            FindBills(),
+            RefreshShareBill(),
+        ))
 
 
 class FindBills(Action):
     ACTION_FIND_BILL = 0
+    MAX_RESULTS = 11
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_FIND_BILLS)
@@ -40,68 +37,97 @@ class FindBills(Action):
     def find_bills(self, bot, iq, trans):
         query = iq.query
         bill_ids = trans.get_bill_details_by_name(query, iq.from_user.id)
+        results = self.get_bill_results(bill_ids[:self.MAX_RESULTS], trans)
+        if len(bill_ids) < self.MAX_RESULTS:
+            archived = trans.find_archived_bills(
+                query, iq.from_user.id, self.MAX_RESULTS - len(bill_ids)
+            )
+            if len(archived) > 0:
+                # Shown as they are in the archive. A bill is only restored
+                # once it is opened or its result is chosen.
+                with trans.archived_reads():
+                    results.extend(self.get_bill_results(archived, trans))
+
+        iq.answer(results)
+
+    def get_bill_results(self, bill_ids, trans):
         results = []
-        for i, details in enumerate(bill_ids):
-            if i > 10:
-                break
-            bill_id, closed_at = details
+        for bill_id, closed_at, token in bill_ids:
             result = None
             if closed_at is None:
-                result = self.get_sharing_bill_result(bill_id, trans)
+                result = self.get_sharing_bill_result(bill_id, token, trans)
             else:
-                result = self.get_debt_bill_result(bill_id, trans)
+                result = self.get_debt_bill_result(bill_id, token, trans)
 
             if result is not None:
                 results.append(result)
+        return results
 
-        iq.answer(results)
+    @staticmethod
+    def get_sharing_bill_result(bill_id, token, trans):
+        article = render_cache.get(
+            'inline_share', bill_id, trans.get_bill_version(bill_id),
+            lambda: FindBills.render_sharing_bill(bill_id, trans)
+        )
+        if article is None:
+            return
+        kb = get_redirect_share_keyboard(bill_id, token)
+        return FindBills.get_bill_result(bill_id, article, kb)
+
+    @staticmethod
+    def get_debt_bill_result(bill_id, token, trans):
+        article = render_cache.get(
+            'inline_debts', bill_id, trans.get_bill_version(bill_id),
+            lambda: FindBills.render_debt_bill(bill_id, trans)
+        )
+        kb = get_redirect_pay_keyboard(bill_id, token)
+        return FindBills.get_bill_result(bill_id, article, kb)
 
     @staticmethod
-    def get_sharing_bill_result(bill_id, trans):
+    def render_sharing_bill(bill_id, trans):
         details = trans.get_bill_details(bill_id)
         msg = utils.format_complete_bill_text(details, bill_id, trans)
         if msg is None:
             return
-        kb = get_redirect_share_keyboard(bill_id)
-        return InlineQueryResultArticle(
-            id=bill_id,
-            title=details.get('title'),
-            input_message_content=InputTextMessageContent(
-                msg[0],
-                parse_mode=msg[1]
-            ),
-            reply_markup=kb,
-            description='{}\nItems: {}'.format(
-                utils.format_time(details.get('time')),
-                str(len(details.get('items')))
-            )
-        )
+        text, pm = msg
+        return [details.get('title'), text, pm,
+                FindBills.get_bill_description(details)]
 
     @staticmethod
-    def get_debt_bill_result(bill_id, trans):
+    def render_debt_bill(bill_id, trans):
         details = trans.get_bill_details(bill_id)
         debts, unique_users = utils.calculate_remaining_debt(bill_id, trans)
         text, pm = utils.format_debts_bill_text(
             bill_id, debts, unique_users, trans
         )
-        kb = get_redirect_pay_keyboard(bill_id)
+        return [details.get('title'), text, pm,
+                FindBills.get_bill_description(details)]
+
+    @staticmethod
+    def get_bill_description(details):
+        return '{}\nItems: {}'.format(
+            utils.format_time(details.get('time')),
+            str(len(details.get('items')))
+        )
+
+    @staticmethod
+    def get_bill_result(bill_id, article, kb):
+        title, text, pm, description = article
         return InlineQueryResultArticle(
-            id=bill_id,
-            title=details.get('title'),
+            id=str(bill_id),
+            title=title,
             input_message_content=InputTextMessageContent(
                 text,
                 parse_mode=pm
             ),
             reply_markup=kb,
-            description='{}\nItems: {}'.format(
-                utils.format_time(details.get('time')),
-                str(len(details.get('items')))
-            )
+            description=description
         )
 
 
 class RefreshShareBill(Action):
     ACTION_REFRESH_SHARE_BILL = 0
+    read_only = True
 
     def __init__(self):
         super().__init__(MODULE_ACTION_TYPE, ACTION_REFRESH_SHARE_BILL)
@@ -118,9 +144,9 @@ class RefreshShareBill(Action):
                 self.refresh_debt_bill(bill_id, cbq, trans)
 
     def refresh_share_bill(self, bill_id, cbq, trans):
-        details = trans.get_bill_details(bill_id)
-        text, pm = utils.format_complete_bill_text(details, bill_id, trans)
-        kb = get_redirect_share_keyboard(bill_id)
+        text, pm = utils.get_complete_bill_text(bill_id, trans)
+        token = trans.get_bill_token(bill_id)
+        kb = get_redirect_share_keyboard(bill_id, token)
         cbq.answer()
         cbq.edit_message_text(
             text=text,
@@ -129,11 +155,9 @@ class RefreshShareBill(Action):
         )
 
     def refresh_debt_bill(self, bill_id, cbq, trans):
-        debts, unique_users = utils.calculate_remaining_debt(bill_id, trans)
-        text, pm = utils.format_debts_bill_text(
-            bill_id, debts, unique_users, trans
-        )
-        kb = get_redirect_pay_keyboard(bill_id)
+        text, pm = utils.get_debts_bill_text(bill_id, trans)
+        token = trans.get_bill_token(bill_id)
+        kb = get_redirect_pay_keyboard(bill_id, token)
         cbq.answer()
         cbq.edit_message_text(
             text=text,
@@ -142,7 +166,7 @@ class RefreshShareBill(Action):
         )
 
 
-def get_redirect_share_keyboard(bill_id):
+def get_redirect_share_keyboard(bill_id, token):
     refresh_btn = InlineKeyboardButton(
         text='🔄 Refresh',
         callback_data=utils.get_action_callback_data(
@@ -154,7 +178,7 @@ def get_redirect_share_keyboard(bill_id):
     inspect_btn = InlineKeyboardButton(
         text='👉 Pick items',
         url='https://telegram.me/{}?start={}'.format(
-            EnvSettings.APP_NAME, bill_id
+            EnvSettings.APP_NAME, token
         )
     )
 
@@ -164,7 +188,7 @@ def get_redirect_share_keyboard(bill_id):
     ])
 
 
-def get_redirect_pay_keyboard(bill_id):
+def get_redirect_pay_keyboard(bill_id, token):
     refresh_btn = InlineKeyboardButton(
         text='🔄 Refresh',
         callback_data=utils.get_action_callback_data(
@@ -176,7 +200,7 @@ def get_redirect_pay_keyboard(bill_id):
     inspect_btn = InlineKeyboardButton(
         text='💸 Pay Debts',
         url='https://telegram.me/{}?start={}'.format(
-            EnvSettings.APP_NAME, bill_id
+            EnvSettings.APP_NAME, token
         )
     )
 
@@ -193,3 +217,6 @@ def is_closed(bill_id, trans):
         return False
 
     return True
+
+
+registry.register_handler(BillShareHandler())
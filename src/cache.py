@@ -0,0 +1,342 @@
+import urllib.parse as urlparse
+import threading
+import logging
+import socket
+import json
+import time
+import uuid
+
+# Every key of this bot is prefixed with this in the shared cache
+KEY_PREFIX = 'whopay:'
+
+
+class CacheError(Exception):
+    pass
+
+
+class LocalCache:
+    """\
+    In-process cache backend. Values are stored JSON encoded, so they come
+    back the same as from RedisCache.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[1] < time.time():
+            return None
+        return json.loads(entry[0])
+
+    def set(self, key, value, ttl):
+        entry = (json.dumps(value), time.time() + ttl)
+        with self.lock:
+            if (len(self.entries) >= self.max_size and
+                    key not in self.entries):
+                self.entries.clear()
+            self.entries[key] = entry
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCache:
+    """\
+    Cache backend on a server speaking the Redis protocol (RESP), shared by
+    the webhook process and every worker. Each thread keeps its own
+    connection.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 timeout=1):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.local = threading.local()
+
+    @classmethod
+    def from_url(cls, url):
+        url = urlparse.urlparse(url)
+        return cls(
+            host=url.hostname or 'localhost',
+            port=url.port or 6379,
+            db=int(url.path[1:] or 0),
+            password=url.password
+        )
+
+    def get(self, key):
+        value = self.command('GET', key)
+        if value is None:
+            return None
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key, value, ttl):
+        self.command('SET', key, json.dumps(value), 'EX', int(ttl))
+
+    def delete(self, key):
+        self.command('DEL', key)
+
+    def command(self, *args):
+        conn = getattr(self.local, 'conn', None)
+        try:
+            if conn is None:
+                conn = self.connect()
+            return conn.execute(*args)
+        except (OSError, CacheError) as e:
+            # Reconnect on the next command
+            if conn is not None:
+                conn.close()
+            self.local.conn = None
+            raise e
+
+    def connect(self):
+        conn = RespConnection(self.host, self.port, self.timeout)
+        self.local.conn = conn
+        if self.password is not None:
+            conn.execute('AUTH', self.password)
+        if self.db != 0:
+            conn.execute('SELECT', self.db)
+        return conn
+
+
+class RespConnection:
+    """\
+    One socket to a Redis protocol server. Commands are sent as arrays of
+    bulk strings and their replies read back one at a time.
+    """
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.reader = self.sock.makefile('rb')
+
+    def execute(self, *args):
+        parts = [b'*' + str(len(args)).encode() + b'\r\n']
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$' + str(len(arg)).encode() + b'\r\n')
+            parts.append(arg + b'\r\n')
+        self.sock.sendall(b''.join(parts))
+        return self.read_reply()
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise CacheError('Connection closed')
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body
+        if kind == b'-':
+            raise CacheError(body.decode('utf-8'))
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise CacheError('Connection closed')
+            return data[:-2]
+        if kind == b'*':
+            length = int(body)
+            if length < 0:
+                return None
+            return [self.read_reply() for __ in range(length)]
+        raise CacheError('Unknown reply {}'.format(line))
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+backend = LocalCache()
+
+# Tells this process' own cache_changed notifications apart from others'
+ORIGIN_ID = uuid.uuid4().hex
+
+
+def configure(url=None):
+    """\
+    Selects the backend shared by every cache below: RedisCache when url
+    (redis://[:password@]host[:port][/db]) is set, otherwise LocalCache.
+    """
+    global backend
+    if url:
+        backend = RedisCache.from_url(url)
+    else:
+        backend = LocalCache()
+
+
+def is_shared():
+    """\
+    Whether every process sees the same entries. Otherwise the entries of
+    other processes are evicted through InvalidationListener.
+    """
+    return not isinstance(backend, LocalCache)
+
+
+def get_value(key):
+    """\
+    Cache failures are logged and treated as misses, so the bot keeps
+    working from the db when the cache server is down.
+    """
+    try:
+        return backend.get(KEY_PREFIX + key)
+    except Exception as e:
+        logging.warning('cache get {}: {}'.format(key, e))
+
+
+def set_value(key, value, ttl):
+    try:
+        backend.set(KEY_PREFIX + key, value, ttl)
+    except Exception as e:
+        logging.warning('cache set {}: {}'.format(key, e))
+
+
+def delete_value(key):
+    try:
+        backend.delete(KEY_PREFIX + key)
+    except Exception as e:
+        logging.warning('cache delete {}: {}'.format(key, e))
+
+
+class UserCache:
+    """\
+    Cache of the user profiles already stored in the db, keyed by Telegram
+    id. Lets add_user skip the upsert when the profile is unchanged.
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(user_id):
+        return 'user:{}'.format(user_id)
+
+    def is_fresh(self, user_id, first_name, last_name, username):
+        return get_value(self.get_key(user_id)) == [first_name, last_name, username]
+
+    def set(self, user_id, first_name, last_name, username):
+        set_value(self.get_key(user_id),
+                  [first_name, last_name, username], self.ttl)
+
+    def invalidate(self, user_id):
+        delete_value(self.get_key(user_id))
+
+
+class SessionCache:
+    """\
+    Cache of the sessions table, keyed by (chat_id, user_id). Written
+    through once the transaction that changed the session commits. Every
+    update of a chat is handled by the same process, so no other process
+    holds a copy to evict.
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(chat_id, user_id):
+        return 'session:{}:{}'.format(chat_id, user_id)
+
+    def get(self, chat_id, user_id):
+        return get_value(self.get_key(chat_id, user_id))
+
+    def set(self, chat_id, user_id, session):
+        set_value(self.get_key(chat_id, user_id), session, self.ttl)
+
+    def invalidate(self, chat_id, user_id):
+        delete_value(self.get_key(chat_id, user_id))
+
+
+class RenderCache:
+    """\
+    Cache of values rendered from a bill, stored with the bill's version
+    (Transaction.get_bill_version). Any change to a bill, or to the
+    profile of a user on it, changes its version, so an entry is only used
+    while its version matches the one read in the transaction.
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(kind, bill_id):
+        return 'render:{}:{}'.format(kind, bill_id)
+
+    def get(self, kind, bill_id, version, render):
+        key = self.get_key(kind, bill_id)
+        entry = get_value(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        value = render()
+        if value is not None:
+            set_value(key, [version, value], self.ttl)
+        return value
+
+
+class SelectionCache:
+    """\
+    In-process multi-select state of inline keyboards, keyed by e.g.
+    (chat_id, user_id, bill_id). Every update of a chat is handled by the
+    same process, so the state does not need to be shared. Entries expire
+    ttl seconds after they were last changed.
+    """
+    def __init__(self, ttl=900, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.selections = {}
+
+    def get(self, key):
+        with self.lock:
+            return self.get_unlocked(key)
+
+    def toggle(self, key, value):
+        with self.lock:
+            selected = self.get_unlocked(key)
+            if value in selected:
+                selected = selected - {value}
+            else:
+                selected = selected | {value}
+            self.set_unlocked(key, selected)
+        return selected
+
+    def set(self, key, selected):
+        with self.lock:
+            self.set_unlocked(key, frozenset(selected))
+
+    def clear(self, key):
+        with self.lock:
+            self.selections.pop(key, None)
+
+    def get_unlocked(self, key):
+        entry = self.selections.get(key)
+        if entry is None or entry[1] < time.time():
+            return frozenset()
+        return entry[0]
+
+    def set_unlocked(self, key, selected):
+        if len(selected) < 1:
+            self.selections.pop(key, None)
+            return
+        if (len(self.selections) >= self.max_size and
+                key not in self.selections):
+            self.selections.clear()
+        self.selections[key] = (selected, time.time() + self.ttl)
+
+
+user_cache = UserCache()
+session_cache = SessionCache()
+render_cache = RenderCache()
+payment_selections = SelectionCache()
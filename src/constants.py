@@ -10,9 +10,15 @@ JSON_TAX_ID = 't'
 JSON_USER_ID = 'u'
 JSON_CREDITOR_ID = 'c'
 JSON_PAYMENT_ID = 'p'
+JSON_PAYMENT_IDS = 'ps'
 
 PAY_TYPE_NORMAL = 0
 
+PAY_STATUS_WITHDRAWN = 0
+PAY_STATUS_PENDING = 1
+PAY_STATUS_CONFIRMED = 2
+PAY_STATUS_FORCED = 3
+
 EMOJI_MONEY_BAG = '\U0001F4B0'
 EMOJI_TAX = '\U0001F4B8'
 EMOJI_PERSON = '\U0001F464'
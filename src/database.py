@@ -1,85 +1,622 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import uuid
 import json
 import utils
-import math
+import time
+import threading
+import itertools
+import functools
+import contextlib
+import logging
+import constants as const
+from cache import user_cache, session_cache
+import cache
+import invalidation
+
+PAID_STATUSES = (const.PAY_STATUS_CONFIRMED, const.PAY_STATUS_FORCED)
+
+# Latest status of payment p, from the payment_events ledger
+PAYMENT_STATUS_JOIN = """\
+    INNER JOIN LATERAL (
+        SELECT e.status
+        FROM payment_events e
+        WHERE e.payment_id = p.id
+        ORDER BY e.id DESC
+        LIMIT 1
+    ) s ON TRUE
+"""
+
+# Balance of debt d: its debt_balances snapshot plus the events after it
+DEBT_BALANCE_JOIN = """\
+    LEFT JOIN debt_balances b ON b.debt_id = d.id
+    INNER JOIN LATERAL (
+        SELECT SUM(e.paid_delta) AS paid_amount,
+            SUM(e.pending_delta) AS pending_count,
+            SUM(e.forced_delta) AS forced_count
+        FROM payment_events e
+        WHERE e.debt_id = d.id
+        AND e.txid >= COALESCE(b.event_txid, 0)
+    ) t ON TRUE
+"""
+DEBT_PAID_AMOUNT = "COALESCE(b.paid_amount, 0) + COALESCE(t.paid_amount, 0)"
+DEBT_IS_PENDING = \
+    "COALESCE(b.pending_count, 0) + COALESCE(t.pending_count, 0) > 0"
+DEBT_IS_FORCED = \
+    "COALESCE(b.forced_count, 0) + COALESCE(t.forced_count, 0) > 0"
+
+# Amounts are in cents; smaller differences are float noise
+AMOUNT_EPSILON = 0.005
+
+# Advisory lock key held exclusively while snapshotting debt balances and
+# shared while moving bills to or from the archive
+SNAPSHOT_LOCK_ID = 0x64656274
+
+# Sessions idle for longer than this many seconds are deleted
+SESSION_TTL = 7 * 24 * 3600
+
+# Bills never marked done are deleted this many seconds after creation
+DRAFT_BILL_TTL = 30 * 24 * 3600
+
+# Settled bills are archived this many seconds after they were closed or
+# last restored
+ARCHIVE_BILL_AGE = 90 * 24 * 3600
+
+# Seconds to wait for a pooled connection when all of them are in use
+POOL_TIMEOUT = 30
+
+# Tables moved with a bill between the public and archive schemas, as
+# (table, column, referenced CTE, referenced column), referenced first
+BILL_TABLES = (
+    ('bills', 'id', 'moving', 'id'),
+    ('items', 'bill_id', 'moving', 'id'),
+    ('bill_taxes', 'bill_id', 'moving', 'id'),
+    ('bill_shares', 'bill_id', 'moving', 'id'),
+    ('debts', 'bill_id', 'moving', 'id'),
+    ('payments', 'debt_id', 'moved_debts', 'id'),
+    ('payment_events', 'debt_id', 'moved_debts', 'id'),
+    ('debt_balances', 'debt_id', 'moved_debts', 'id'),
+)
+
+
+def get_move_bills_query(source, target, select_bills):
+    """\
+    Statement moving the bills whose ids select_bills returns, and every
+    row of BILL_TABLES that refers to them, from schema source to schema
+    target. Returns the ids of the bills moved.
+    """
+    ctes = ['moving AS ({})'.format(select_bills)]
+    for table, column, parent, parent_column in BILL_TABLES:
+        ctes.append(
+            'moved_{0} AS (DELETE FROM {1}.{0} r USING {2} p '
+            'WHERE r.{3} = p.{4} RETURNING r.*)'.format(
+                table, source, parent, column, parent_column
+            )
+        )
+    for table, __, __, __ in BILL_TABLES[1:]:
+        ctes.append(
+            'inserted_{0} AS (INSERT INTO {1}.{0} '
+            'SELECT * FROM moved_{0})'.format(table, target)
+        )
+    return 'WITH {}\nINSERT INTO {}.bills SELECT * FROM moved_bills ' \
+        'RETURNING id'.format(',\n'.join(ctes), target)
+
+
+ARCHIVE_BILLS_QUERY = get_move_bills_query('public', 'archive', """\
+    SELECT bl.id FROM bills bl
+    WHERE bl.closed_at IS NOT NULL
+    AND COALESCE(bl.restored_at, bl.closed_at) <
+        NOW() - %s * INTERVAL '1 second'
+    AND NOT EXISTS (
+        SELECT 1 FROM debts d
+        {}
+        WHERE d.bill_id = bl.id
+        AND d.is_deleted = FALSE
+        AND ({} OR {} < d.original_amt - {})
+    )
+    ORDER BY COALESCE(bl.restored_at, bl.closed_at)
+    LIMIT %s
+    FOR UPDATE OF bl SKIP LOCKED
+""".format(DEBT_BALANCE_JOIN, DEBT_IS_PENDING, DEBT_PAID_AMOUNT,
+           AMOUNT_EPSILON))
+
+RESTORE_BILL_QUERY = get_move_bills_query(
+    'archive', 'public', 'SELECT %s::BIGINT AS id'
+)
+
+USER_JSON = """\
+    json_build_object('id', {0}.id, 'first_name', {0}.first_name,
+        'last_name', {0}.last_name, 'username', {0}.username)"""
+
+
+def get_export_bills_query(schema):
+    """\
+    One JSON document per bill in schema that %(user_id)s owns or shares,
+    with its items, taxes, shares, debts and payments.
+    """
+    return """\
+        SELECT json_build_object(
+            'id', b.id,
+            'title', b.title,
+            'owner', {owner},
+            'created_at', b.created_at,
+            'completed_at', b.completed_at,
+            'closed_at', b.closed_at,
+            'items', (
+                SELECT json_agg(json_build_object(
+                    'id', i.id, 'name', i.name, 'price', i.price
+                ) ORDER BY i.created_at)
+                FROM {schema}.items i
+                WHERE i.bill_id = b.id
+            ),
+            'taxes', (
+                SELECT json_agg(json_build_object(
+                    'title', bt.title, 'amount', bt.amount
+                ) ORDER BY bt.created_at)
+                FROM {schema}.bill_taxes bt
+                WHERE bt.bill_id = b.id
+            ),
+            'shares', (
+                SELECT json_agg(json_build_object(
+                    'item_id', bs.item_id, 'user', {sharer}
+                ) ORDER BY bs.created_at)
+                FROM {schema}.bill_shares bs
+                INNER JOIN users su ON su.id = bs.user_id
+                WHERE bs.bill_id = b.id
+                AND NOT bs.is_deleted
+            ),
+            'debts', (
+                SELECT json_agg(json_build_object(
+                    'debtor', {debtor},
+                    'creditor', {creditor},
+                    'amount', d.original_amt,
+                    'payments', (
+                        SELECT json_agg(json_build_object(
+                            'amount', p.amount,
+                            'comments', p.comments,
+                            'created_at', p.created_at,
+                            'status', (
+                                SELECT CASE e.status
+                                    WHEN {withdrawn} THEN 'withdrawn'
+                                    WHEN {pending} THEN 'pending'
+                                    WHEN {confirmed} THEN 'confirmed'
+                                    WHEN {forced} THEN 'force_confirmed'
+                                END
+                                FROM {schema}.payment_events e
+                                WHERE e.payment_id = p.id
+                                ORDER BY e.id DESC
+                                LIMIT 1
+                            )
+                        ) ORDER BY p.id)
+                        FROM {schema}.payments p
+                        WHERE p.debt_id = d.id
+                    )
+                ) ORDER BY d.creditor_id, d.debtor_id)
+                FROM {schema}.debts d
+                INNER JOIN users du ON du.id = d.debtor_id
+                INNER JOIN users cu ON cu.id = d.creditor_id
+                WHERE d.bill_id = b.id
+                AND d.is_deleted = FALSE
+            )
+        )::text
+        FROM {schema}.bills b
+        INNER JOIN users ou ON ou.id = b.owner_id
+        WHERE b.id IN (
+            SELECT ob.id FROM {schema}.bills ob
+            WHERE ob.owner_id = %(user_id)s
+            UNION
+            SELECT sb.bill_id FROM {schema}.bill_shares sb
+            WHERE sb.user_id = %(user_id)s
+            AND NOT sb.is_deleted
+        )
+    """.format(
+        schema=schema,
+        withdrawn=const.PAY_STATUS_WITHDRAWN,
+        pending=const.PAY_STATUS_PENDING,
+        confirmed=const.PAY_STATUS_CONFIRMED,
+        forced=const.PAY_STATUS_FORCED,
+        owner=USER_JSON.format('ou'),
+        sharer=USER_JSON.format('su'),
+        debtor=USER_JSON.format('du'),
+        creditor=USER_JSON.format('cu')
+    )
+
+
+# Archived bills are part of a user's history too
+EXPORT_BILLS_QUERY = '{}\nUNION ALL\n{}'.format(
+    get_export_bills_query('public'),
+    get_export_bills_query('archive')
+)
+
+
+def bill_read(func):
+    """\
+    Memoizes a read of a bill's data, keyed by the bill id passed first,
+    until the end of the transaction or until a mutator changes the bill.
+    """
+    @functools.wraps(func)
+    def wrapper(self, bill_id, *args):
+        reads = self.bill_reads.setdefault(bill_id, {})
+        key = (func.__name__,) + args
+        if key not in reads:
+            reads[key] = func(self, bill_id, *args)
+        return reads[key]
+    return wrapper
+
+
+def bill_write(func):
+    """\
+    Drops the memoized reads of the bill whose id is passed first.
+    """
+    @functools.wraps(func)
+    def wrapper(self, bill_id, *args, **kwargs):
+        try:
+            return func(self, bill_id, *args, **kwargs)
+        finally:
+            self.bill_reads.pop(bill_id, None)
+    return wrapper
+
+
+def payment_write(func):
+    """\
+    Drops the memoized reads of every bill, for payment mutators that do
+    not know which bill they change.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.bill_reads.clear()
+    return wrapper
 
 
 class Database:
-    def __init__(self, host, db, port, user, pw):
+    def __init__(self, host, db, port, user, pw, replicas=None,
+                 max_replica_lag=5, pool_size=40):
         self.host = host
         self.db = db
         self.port = port
         self.user = user
         self.pw = pw
-
-    def get_connection(self):
-        return Connection(
-            self.host,
-            self.db,
-            self.port,
-            self.user,
-            self.pw
+        self.dsn = "postgresql://{}:{}@{}:{}/{}".format(
+            user, pw, host, port, db
         )
 
+        # Read-only transactions may be routed to these hot standbys
+        self.replicas = replicas or []
+        self.max_replica_lag = max_replica_lag
+        self.replica_counter = itertools.count()
+        self.replica_lag = {}
+        self.recent_writers = {}
+        self.lock = threading.Lock()
 
-class Connection:
-    def __init__(self, host, db, port, user, pw):
-        conn = psycopg2.connect(
-            "postgresql://{}:{}@{}:{}/{}".format(
-                user, pw, host, port, db
+        self.pool_size = pool_size
+        self.pools = {}
+
+    def get_config(self):
+        """\
+        Constructor arguments, used to build an independent Database (own
+        pools and replica state) in a worker process.
+        """
+        return {
+            'host': self.host,
+            'db': self.db,
+            'port': self.port,
+            'user': self.user,
+            'pw': self.pw,
+            'replicas': self.replicas,
+            'max_replica_lag': self.max_replica_lag,
+            'pool_size': self.pool_size,
+        }
+
+    def get_pool(self, dsn):
+        with self.lock:
+            pool = self.pools.get(dsn)
+            if pool is None:
+                pool = BlockingConnectionPool(
+                    1,
+                    self.pool_size,
+                    dsn,
+                    timeout=POOL_TIMEOUT,
+                    connection_factory=PooledConnection
+                )
+                self.pools[dsn] = pool
+            return pool
+
+    def get_connection(self, read_only=False, user_id=None, chat_id=None):
+        if read_only and len(self.replicas) > 0:
+            if not self.has_recent_write(user_id, chat_id):
+                conn = self.get_replica_connection()
+                if conn is not None:
+                    return conn
+
+        return Connection(self.get_pool(self.dsn))
+
+    def get_replica_connection(self):
+        """\
+        Returns a connection to the next replica whose replication lag is
+        within max_replica_lag, or None if every replica is lagging.
+        """
+        start = next(self.replica_counter)
+        for i in range(len(self.replicas)):
+            dsn = self.replicas[(start + i) % len(self.replicas)]
+            conn = None
+            try:
+                conn = Connection(self.get_pool(dsn))
+                if self.get_replica_lag(dsn, conn) <= self.max_replica_lag:
+                    return conn
+                conn.release()
+            except Exception as e:
+                logging.exception('get_replica_connection')
+                # Gives the pool slot back; the connection may be broken
+                if conn is not None:
+                    conn.release(close=True)
+
+        return None
+
+    def get_replica_lag(self, dsn, conn):
+        # Lag is rechecked at most once a second for each replica
+        with self.lock:
+            lag, checked_at = self.replica_lag.get(dsn, (None, 0))
+        if lag is not None and time.time() - checked_at < 1:
+            return lag
+
+        conn.cursor.execute("""\
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                    THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM
+                    NOW() - pg_last_xact_replay_timestamp()), 0)
+            END;
+        """)
+        lag = float(conn.cursor.fetchone()[0])
+        with self.lock:
+            self.replica_lag[dsn] = (lag, time.time())
+        return lag
+
+    def mark_write(self, user_id, chat_id=None):
+        """\
+        Records a committed write by the user in the chat so that reads by
+        the user, or by anyone else in the chat, are kept on the primary
+        until replicas have caught up.
+        """
+        keys = self.get_writer_keys(user_id, chat_id)
+        if len(keys) < 1:
+            return
+        now = time.time()
+        with self.lock:
+            if len(self.recent_writers) > 10000:
+                self.recent_writers = {
+                    key: t for key, t in self.recent_writers.items()
+                    if now - t <= self.max_replica_lag
+                }
+            for key in keys:
+                self.recent_writers[key] = now
+
+    def has_recent_write(self, user_id, chat_id=None):
+        keys = self.get_writer_keys(user_id, chat_id)
+        now = time.time()
+        is_recent = False
+        with self.lock:
+            for key in keys:
+                written_at = self.recent_writers.get(key)
+                if written_at is None:
+                    continue
+                if now - written_at > self.max_replica_lag:
+                    del self.recent_writers[key]
+                else:
+                    is_recent = True
+        return is_recent
+
+    @staticmethod
+    def get_writer_keys(user_id, chat_id):
+        keys = []
+        if user_id is not None:
+            keys.append(('user', user_id))
+        if chat_id is not None:
+            keys.append(('chat', chat_id))
+        return keys
+
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """\
+    ThreadedConnectionPool that makes getconn wait, up to timeout seconds,
+    for a connection to be put back when all maxconn are in use, instead of
+    raising PoolError right away.
+    """
+    def __init__(self, minconn, maxconn, *args, timeout=30, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(
+                'no connection was put back within {}s'.format(self.timeout)
             )
-        )
-        conn.autocommit = True
-        self.cursor = conn.cursor()
+        try:
+            return super().getconn(key)
+        except Exception as e:
+            self.slots.release()
+            raise e
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self.slots.release()
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """\
+    psycopg2 connection that remembers the statements it has PREPAREd,
+    since prepared statements live as long as the db session does.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Connection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = pool.getconn()
+        self.conn.autocommit = True
+        self.prepared = self.conn.prepared
+        self.cursor = self.conn.cursor()
+
+    def release(self, close=False):
+        if self.conn is None:
+            return
+        self.cursor.close()
+        self.pool.putconn(self.conn, close=close or bool(self.conn.closed))
+        self.conn = None
 
 
 class Transaction:
-    def __init__(self, connection):
+    def __init__(self, connection, read_only=False):
+        self.connection = connection
         self.cursor = connection.cursor
+        self.read_only = read_only
+        self.on_commit = []
+        # Results of @bill_read methods, by bill id
+        self.bill_reads = {}
+        # Sessions written in this transaction, by (chat_id, user_id)
+        self.session_writes = {}
+        # Cache keys to evict from other processes' caches on commit
+        self.changed_keys = set()
+        # Archived bills a read-only transaction could not restore
+        self.archived_bills = set()
+        # Set by a read-only action that turned out to need a write; the
+        # handler runs it again in a read-write transaction
+        self.needs_write = False
 
     def __enter__(self):
-        self.cursor.execute("BEGIN;")
+        if self.read_only:
+            self.cursor.execute(
+                "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;"
+            )
+        else:
+            self.cursor.execute("BEGIN;")
         self.is_error = False
         return self
 
     def __exit__(self, type, value, traceback):
-        if self.is_error:
-            self.cursor.execute("ROLLBACK;")
+        try:
+            if self.is_error:
+                self.cursor.execute("ROLLBACK;")
+                # PREPAREs made in the aborted transaction may be gone
+                self.cursor.execute("DEALLOCATE ALL;")
+                self.connection.prepared.clear()
+                return
+
+            self.commit()
+        finally:
+            self.connection.release()
+
+        for callback in self.on_commit:
+            callback()
+
+    def commit(self):
+        if len(self.changed_keys) < 1 or cache.is_shared():
+            self.cursor.execute("COMMIT;")
             return
 
-        self.cursor.execute("COMMIT;")
+        # Delivered to the listeners once the COMMIT succeeds
+        self.cursor.execute("""\
+            SELECT pg_notify(%s, n) FROM unnest(%s::text[]) n;
+            COMMIT;
+        """, (invalidation.CACHE_CHANGED, [
+            cache.ORIGIN_ID + ' ' + key for key in self.changed_keys
+        ]))
+
+    def notify_changed(self, key):
+        """\
+        Evicts key from the caches of other processes once this transaction
+        commits. NOTIFY takes a database-wide lock at commit, so this is
+        only for keys other processes may hold: user profiles, cached by
+        every process a user's chats are routed to. Sessions are not, as
+        all updates of a chat are handled by the same process.
+        """
+        self.changed_keys.add(key)
+
+    def execute_prepared(self, name, query, params):
+        """\
+        Runs query as a named prepared statement, PREPAREing it the first
+        time it is used on this connection. query uses $1, $2... params.
+        """
+        if name not in self.connection.prepared:
+            self.cursor.execute("PREPARE {} AS {}".format(name, query))
+            self.connection.prepared.add(name)
+
+        self.cursor.execute(
+            "EXECUTE {} ({})".format(name, ', '.join(['%s'] * len(params))),
+            params
+        )
+
+    def row_lock(self, *tables):
+        """\
+        Read-only transactions read from a snapshot and take no row locks.
+        """
+        if self.read_only:
+            return ''
+        if len(tables) > 0:
+            return 'FOR UPDATE OF ' + ', '.join(tables)
+        return 'FOR UPDATE'
 
     def add_user(self, user_id, first_name, last_name,
                  username, is_ignore_id=False):
         try:
+            if self.read_only:
+                # Profile changes are picked up by the next write transaction
+                return user_id
+
+            if not is_ignore_id and user_cache.is_fresh(
+                    user_id, first_name, last_name, username):
+                return user_id
+
             if is_ignore_id:
+                # Users added by name get negative ids from a descending
+                # sequence, so adding them takes no locks
                 self.cursor.execute("""\
-                    SELECT u.id FROM users u
-                    ORDER BY id ASC
-                    LIMIT 1
-                    FOR UPDATE;
-                """)
-                last_uid = self.cursor.fetchone()[0]
-                if last_uid > 0:
-                    user_id = -1
-                else:
-                    user_id = last_uid - 1
+                    INSERT INTO users (id, first_name, last_name, username)
+                        VALUES(nextval('proxy_user_id_seq'), %s, %s, %s)
+                    RETURNING id;
+                """, (first_name, last_name, username)
+                )
+                return self.cursor.fetchone()[0]
 
+            # Only rewrite the row when the profile actually changed
             self.cursor.execute("""\
                 INSERT INTO users (id, first_name, last_name, username)
                     VALUES(%s, %s, %s, %s)
                 ON CONFLICT(id) DO UPDATE SET
                     id=EXCLUDED.id, first_name=EXCLUDED.first_name,
                     last_name=EXCLUDED.last_name, username=EXCLUDED.username
+                WHERE (users.first_name, users.last_name, users.username)
+                    IS DISTINCT FROM (EXCLUDED.first_name,
+                        EXCLUDED.last_name, EXCLUDED.username)
                 RETURNING id;
             """, (user_id, first_name, last_name, username)
             )
 
             rows = self.cursor.fetchall()
-            if len(rows) != 1:
+            if len(rows) > 1:
                 raise Exception('User not added')
-            return rows[0][0]
+            if len(rows) > 0:
+                self.notify_changed(user_cache.get_key(user_id))
+                # Memoized reads such as get_sharers and get_debts carry
+                # names, which may just have changed
+                self.bill_reads.clear()
+
+            self.on_commit.append(
+                lambda: user_cache.set(user_id, first_name,
+                                       last_name, username)
+            )
+            return user_id
         except Exception as e:
             self.is_error = True
             raise e
@@ -90,10 +627,10 @@ class Transaction:
             data = json.dumps(data)
 
         try:
-            self.cursor.execute("""\
+            self.execute_prepared('add_session', """\
                 INSERT INTO sessions (chat_id, user_id, action_type,
                     action_id, subaction_id, data, updated_at)
-                    VALUES(%s, %s, %s, %s, %s, %s, NOW())
+                    VALUES($1, $2, $3, $4, $5, $6, NOW())
                 ON CONFLICT(chat_id, user_id) DO UPDATE SET
                     chat_id=EXCLUDED.chat_id,
                     user_id=EXCLUDED.user_id,
@@ -104,22 +641,59 @@ class Transaction:
                     updated_at=EXCLUDED.updated_at;
             """, (chat_id, user_id, action_type, action_id, subaction_id, data)
             )
+            self.write_session(
+                chat_id, user_id, [action_type, action_id, subaction_id, data]
+            )
         except Exception as e:
             self.is_error = True
             raise e
 
+    def write_session(self, chat_id, user_id, session):
+        """\
+        Writes session through to the session cache once this transaction
+        commits, or drops the cached one if session is None.
+        """
+        key = (chat_id, user_id)
+        if key not in self.session_writes:
+            self.on_commit.append(
+                lambda: self.commit_session(chat_id, user_id)
+            )
+        self.session_writes[key] = session
+
+    def commit_session(self, chat_id, user_id):
+        session = self.session_writes[(chat_id, user_id)]
+        if session is None:
+            session_cache.invalidate(chat_id, user_id)
+        else:
+            session_cache.set(chat_id, user_id, session)
+
     def get_session(self, chat_id, user_id):
         """\
-        Get pending action. Also serves as lock against concurrent access.
+        Get pending action. Also serves as lock against concurrent access,
+        unless the session is cached. Callers must run on the bot's
+        OrderedScheduler, which handles the updates of a chat one at a
+        time, in the single process the chat is routed to.
         """
         try:
-            self.cursor.execute("""\
+            key = (chat_id, user_id)
+            if key in self.session_writes:
+                session = self.session_writes[key]
+            else:
+                session = session_cache.get(chat_id, user_id)
+            if session is not None:
+                return self.load_session(session)
+
+            lock = self.row_lock()
+            self.execute_prepared(
+                'get_session_locked' if lock else 'get_session',
+                """\
                 SELECT s.action_type, s.action_id, s.subaction_id,
                     s.data FROM sessions s
-                WHERE s.chat_id = %s
-                    AND s.user_id = %s
-                FOR UPDATE;
-            """, (chat_id, user_id)
+                WHERE s.chat_id = $1
+                    AND s.user_id = $2
+                {}
+                """.format(lock),
+                (chat_id, user_id)
             )
             if self.cursor.description is None:
                 raise Exception('no results')
@@ -129,58 +703,310 @@ class Transaction:
             if len(rows) > 1:
                 raise Exception('More than 1 action.')
 
-            data = rows[0][3]
-            if data is not None:
-                data = json.loads(data)
+            if len(rows) < 1:
+                # Never started, or reaped after SESSION_TTL
+                session = [None, None, None, None]
             else:
-                data = {}
-
-            return rows[0][0], rows[0][1], rows[0][2], data
+                session = list(rows[0])
+            if not self.read_only:
+                # Replicas may lag behind, so only the primary fills the cache
+                self.on_commit.append(
+                    lambda: session_cache.set(chat_id, user_id, session)
+                )
+            return self.load_session(session)
         except Exception as e:
             self.is_error = True
             raise e
 
+    @staticmethod
+    def load_session(session):
+        action_type, action_id, subaction_id, data = session
+        if data is not None:
+            data = json.loads(data)
+        else:
+            data = {}
+
+        return action_type, action_id, subaction_id, data
+
     def reset_session(self, chat_id, user_id, data=None):
         try:
             self.cursor.execute("""\
                 UPDATE sessions
                 SET action_type = NULL, action_id = NULL,
-                    subaction_id = NULL, data = %s
+                    subaction_id = NULL, data = %s, updated_at = NOW()
                 WHERE chat_id = %s
                     AND user_id = %s
             """, (data, chat_id, user_id)
             )
+            if self.cursor.rowcount > 0:
+                session = [None, None, None, data]
+            else:
+                session = None
+            self.write_session(chat_id, user_id, session)
+        except Exception as e:
+            self.is_error = True
+            raise e
+
+    def reap_sessions(self, ttl=SESSION_TTL, batch_size=500):
+        """\
+        Deletes up to batch_size sessions idle for more than ttl seconds,
+        oldest first. Sessions in use are skipped rather than waited on.
+        """
+        try:
+            self.cursor.execute("""\
+                DELETE FROM sessions s
+                USING (
+                    SELECT chat_id, user_id FROM sessions
+                    WHERE updated_at < NOW() - %s * INTERVAL '1 second'
+                    ORDER BY updated_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) r
+                WHERE s.chat_id = r.chat_id
+                AND s.user_id = r.user_id
+                RETURNING s.chat_id, s.user_id
+            """, (ttl, batch_size)
+            )
+            rows = self.cursor.fetchall()
+            for chat_id, user_id in rows:
+                self.write_session(chat_id, user_id, None)
+            return len(rows)
         except Exception as e:
             self.is_error = True
             raise e
 
     def add_bill(self, title, owner_id):
         try:
-            count = 0
-            while count < 10:
-                bill_id = self.generate_id(16)
-                self.cursor.execute("""\
-                    INSERT INTO bills (id, title, owner_id)
-                        VALUES (%s, %s, %s)
-                    ON CONFLICT(id) DO NOTHING
-                    RETURNING id;
-                """, (bill_id, title, owner_id)
+            self.cursor.execute("""\
+                INSERT INTO bills (token, title, owner_id)
+                    VALUES (%s, %s, %s)
+                RETURNING id;
+            """, (self.generate_id(16), title, owner_id)
+            )
+            return self.cursor.fetchone()[0]
+        except Exception as ex:
+            self.is_error = True
+            raise ex
+
+    def delete_draft_bills(self, ttl=DRAFT_BILL_TTL, batch_size=200):
+        """\
+        Deletes up to batch_size bills that were never marked done within
+        ttl seconds, with their items, taxes and shares. Drafts that are
+        being edited are skipped rather than waited on.
+        """
+        try:
+            self.cursor.execute("""\
+                WITH drafts AS (
+                    SELECT b.id FROM bills b
+                    WHERE b.completed_at IS NULL
+                    AND b.created_at < NOW() - %s * INTERVAL '1 second'
+                    AND NOT EXISTS (
+                        SELECT 1 FROM debts d WHERE d.bill_id = b.id
+                    )
+                    ORDER BY b.created_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ), deleted_shares AS (
+                    DELETE FROM bill_shares bs
+                    USING drafts WHERE bs.bill_id = drafts.id
+                ), deleted_taxes AS (
+                    DELETE FROM bill_taxes bt
+                    USING drafts WHERE bt.bill_id = drafts.id
+                ), deleted_items AS (
+                    DELETE FROM items i
+                    USING drafts WHERE i.bill_id = drafts.id
+                )
+                DELETE FROM bills b
+                USING drafts WHERE b.id = drafts.id
+                RETURNING b.id
+            """, (ttl, batch_size)
+            )
+            return len(self.cursor.fetchall())
+        except Exception as e:
+            self.is_error = True
+            raise e
+
+    def archive_bills(self, min_age=ARCHIVE_BILL_AGE, batch_size=100):
+        """\
+        Moves up to batch_size settled bills, closed or restored more than
+        min_age seconds ago and with every debt paid, into the archive
+        schema along with their rows.
+        """
+        try:
+            self.lock_snapshots()
+            self.cursor.execute(ARCHIVE_BILLS_QUERY, (min_age, batch_size))
+            return len(self.cursor.fetchall())
+        except Exception as e:
+            self.is_error = True
+            raise e
+
+    @bill_write
+    def restore_bill(self, bill_id):
+        """\
+        Moves bill_id back from the archive. Returns whether it was there.
+        """
+        try:
+            self.lock_snapshots()
+            self.cursor.execute(RESTORE_BILL_QUERY, (bill_id,))
+            if len(self.cursor.fetchall()) < 1:
+                return False
+
+            # Keeps it out of the archive for another ARCHIVE_BILL_AGE
+            self.cursor.execute("""\
+                UPDATE bills SET restored_at = NOW()
+                WHERE id = %s
+            """, (bill_id,)
+            )
+            return True
+        except Exception as e:
+            self.is_error = True
+            raise e
+
+    def lock_snapshots(self):
+        """\
+        Keeps snapshot_debt_balances from running until the end of the
+        transaction, so that it never folds the events of a debt that is
+        being moved.
+        """
+        self.cursor.execute(
+            "SELECT pg_advisory_xact_lock_shared(%s)", (SNAPSHOT_LOCK_ID,)
+        )
+
+    def unarchive_bill(self, bill_id):
+        """\
+        Called when bill_id is missing from the hot tables. Restores it if
+        it was archived and returns whether it was. Read-only transactions
+        cannot, so they note it in archived_bills for the caller to
+        restore on the primary before trying again.
+        """
+        if not self.read_only:
+            return self.restore_bill(bill_id)
+
+        try:
+            self.cursor.execute("""\
+                SELECT 1 FROM archive.bills b
+                WHERE b.id = %s
+            """, (bill_id,)
+            )
+            if self.cursor.fetchone() is not None:
+                self.archived_bills.add(bill_id)
+            return False
+        except Exception as e:
+            self.is_error = True
+            raise e
+
+    def find_archived_bills(self, bill_name, user_id, limit):
+        """\
+        Up to limit archived bills matching get_bill_details_by_name, in
+        the same (id, closed_at, token) form. Render them within
+        archived_reads().
+        """
+        try:
+            self.cursor.execute("""\
+                SELECT b.id, b.closed_at, b.token FROM archive.bills b
+                WHERE LOWER(b.title) LIKE '%%' || LOWER(%s) || '%%'
+                AND (b.owner_id = %s
+                     OR EXISTS(
+                        SELECT * FROM archive.bill_shares bs
+                        WHERE bs.bill_id = b.id
+                        AND bs.user_id = %s
+                        AND NOT bs.is_deleted
+                     )
                 )
-                if self.cursor.description is None:
-                    raise Exception('nothing fetched')
+                ORDER BY b.created_at DESC
+                LIMIT %s;
+                """, (bill_name, user_id, user_id, limit)
+            )
+            return self.cursor.fetchall()
+        except Exception as e:
+            self.is_error = True
+            raise e
 
+    @contextlib.contextmanager
+    def archived_reads(self):
+        """\
+        Points the queries run inside at the archive schema's tables
+        instead of the hot ones (users stay in public), so that archived
+        bills can be read as they are, without restoring them.
+        """
+        self.cursor.execute("SET LOCAL search_path TO archive, public;")
+        try:
+            yield
+        finally:
+            if not self.is_error:
+                self.cursor.execute("SET LOCAL search_path TO DEFAULT;")
+
+    def iter_bill_exports(self, user_id, batch_size=100):
+        """\
+        Yields every bill of user_id as a JSON document, fetched from a
+        server-side cursor batch_size bills at a time.
+        """
+        try:
+            self.cursor.execute(
+                'DECLARE bill_export NO SCROLL CURSOR FOR ' +
+                EXPORT_BILLS_QUERY,
+                {'user_id': user_id}
+            )
+            while True:
+                self.cursor.execute(
+                    'FETCH FORWARD %s FROM bill_export', (batch_size,)
+                )
                 rows = self.cursor.fetchall()
-                if len(rows) > 0:
-                    return bill_id
+                if len(rows) < 1:
+                    break
+                for row in rows:
+                    yield row[0]
+            self.cursor.execute('CLOSE bill_export')
+        except Exception as e:
+            self.is_error = True
+            raise e
 
-                count += 1
+    def get_bill_id(self, token):
+        """\
+        Bills are shared in deep links by their token, not their id.
+        """
+        try:
+            self.execute_prepared('get_bill_id', """\
+                SELECT b.id FROM bills b
+                WHERE b.token = $1
+                """, (token,)
+            )
+            row = self.cursor.fetchone()
+            if row is not None:
+                return row[0]
 
-            if count >= 10:
-                raise Exception("Collision of bills id")
-        except Exception as ex:
+            self.cursor.execute("""\
+                SELECT b.id FROM archive.bills b
+                WHERE b.token = %s
+                """, (token,)
+            )
+            row = self.cursor.fetchone()
+            if row is None or not self.unarchive_bill(row[0]):
+                return None
+            return row[0]
+        except Exception as e:
             self.is_error = True
-            raise ex
+            raise e
+
+    @bill_read
+    def get_bill_token(self, bill_id):
+        try:
+            self.execute_prepared('get_bill_token', """\
+                SELECT b.token FROM bills b
+                WHERE b.id = $1
+                """, (bill_id,)
+            )
+            row = self.cursor.fetchone()
+            if row is None:
+                if self.unarchive_bill(bill_id):
+                    return self.get_bill_token(bill_id)
+                raise Exception('No bill found')
+            return row[0]
+        except Exception as e:
+            self.is_error = True
+            raise e
 
+    @bill_write
     def set_bill_done(self, bill_id, user_id):
         try:
             self.cursor.execute("""\
@@ -198,6 +1024,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def add_item(self, bill_id, item_name, price):
         try:
             self.cursor.execute("""\
@@ -219,7 +1046,7 @@ class Transaction:
             return self.get_all_bill_details(user_id)
         try:
             self.cursor.execute("""\
-                SELECT b.id, b.closed_at FROM bills b
+                SELECT b.id, b.closed_at, b.token FROM bills b
                 WHERE LOWER(b.title) LIKE '%%' || LOWER(%s) || '%%'
                 AND b.completed_at IS NOT NULL
                 AND (b.owner_id = %s
@@ -242,7 +1069,7 @@ class Transaction:
     def get_all_bill_details(self, user_id):
         try:
             self.cursor.execute("""\
-                SELECT b.id, b.closed_at FROM bills b
+                SELECT b.id, b.closed_at, b.token FROM bills b
                 WHERE b.completed_at IS NOT NULL
                 AND (b.owner_id = %s
                      OR EXISTS(
@@ -261,17 +1088,6 @@ class Transaction:
             self.is_error = True
             raise e
 
-    def close_bill(self, bill_id):
-        try:
-            self.cursor.execute("""\
-                UPDATE bills SET closed_at = NOW()
-                WHERE id = %s
-                """, (bill_id,)
-            )
-        except Exception as e:
-            self.is_error = True
-            raise e
-
     def get_bill_details(self, bill_id):
         bill = {
             'title': '',
@@ -294,18 +1110,84 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_read
+    def get_bill_version(self, bill_id):
+        """\
+        Fingerprint of the bill and its items, taxes, shares, debts and
+        payment events, and of the users they name, as seen by this
+        transaction. Every insert, update or delete of one of these rows
+        changes the row versions (xmin, ctid) it is made of, so nothing
+        has to write to the bill row to change it. A renamed user changes
+        the version of every bill they are on.
+        """
+        try:
+            self.execute_prepared('get_bill_version', """\
+                SELECT b.xmin || ':' || b.ctid || ':' || (
+                    SELECT COUNT(*) || ':' || COALESCE(SUM(hashtext(
+                        r.tableoid || ':' || r.ctid || ':' || r.xmin
+                    )), 0)
+                    FROM (
+                        SELECT tableoid, ctid, xmin FROM items
+                        WHERE bill_id = b.id
+                        UNION ALL
+                        SELECT tableoid, ctid, xmin FROM bill_taxes
+                        WHERE bill_id = b.id
+                        UNION ALL
+                        SELECT tableoid, ctid, xmin FROM bill_shares
+                        WHERE bill_id = b.id
+                        UNION ALL
+                        SELECT tableoid, ctid, xmin FROM debts
+                        WHERE bill_id = b.id
+                        UNION ALL
+                        SELECT e.tableoid, e.ctid, e.xmin
+                        FROM payment_events e
+                        INNER JOIN debts d ON d.id = e.debt_id
+                        WHERE d.bill_id = b.id
+                        UNION ALL
+                        SELECT tableoid, ctid, xmin FROM users
+                        WHERE id IN (
+                            SELECT b.owner_id
+                            UNION
+                            SELECT user_id FROM bill_shares
+                            WHERE bill_id = b.id
+                            UNION
+                            SELECT debtor_id FROM debts
+                            WHERE bill_id = b.id
+                            UNION
+                            SELECT creditor_id FROM debts
+                            WHERE bill_id = b.id
+                        )
+                    ) r
+                )
+                FROM bills b
+                WHERE b.id = $1
+                """, (bill_id,)
+            )
+            row = self.cursor.fetchone()
+            if row is None:
+                if self.unarchive_bill(bill_id):
+                    return self.get_bill_version(bill_id)
+                raise Exception('No bill found')
+            return row[0]
+        except Exception as e:
+            self.is_error = True
+            raise e
+
+    @bill_read
     def get_bill_gen_info(self, bill_id):
         try:
-            self.cursor.execute("""\
+            self.execute_prepared('get_bill_gen_info', """\
                 SELECT b.title, b.owner_id, b.completed_at,
                     b.closed_at FROM bills b
-                WHERE b.id = %s
+                WHERE b.id = $1
                 """, (bill_id,)
             )
             if self.cursor.description is None:
                 raise Exception('No bill found')
 
             rows = self.cursor.fetchall()
+            if len(rows) < 1 and self.unarchive_bill(bill_id):
+                return self.get_bill_gen_info(bill_id)
             if len(rows) != 1:
                 raise Exception('More or less than 1 bill found')
 
@@ -314,12 +1196,13 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_read
     def get_bill_items(self, bill_id):
         try:
-            self.cursor.execute("""\
+            self.execute_prepared('get_bill_items', """\
                 SELECT i.id, i.name, i.price
                     FROM items i
-                WHERE i.bill_id = %s
+                WHERE i.bill_id = $1
                 ORDER BY i.created_at
             """, (bill_id,)
             )
@@ -354,6 +1237,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def edit_item_name(self, bill_id, item_id, user_id, name):
         try:
             self.cursor.execute("""\
@@ -380,6 +1264,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def edit_item_price(self, bill_id, item_id, user_id, price):
         try:
             self.cursor.execute("""\
@@ -405,6 +1290,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def delete_item(self, bill_id, item_id, user_id):
         try:
             self.cursor.execute("""\
@@ -430,6 +1316,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_read
     def get_bill_taxes(self, bill_id):
         try:
             self.cursor.execute("""\
@@ -445,6 +1332,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def add_tax(self, bill_id, tax_name, amt):
         try:
             self.cursor.execute("""\
@@ -475,6 +1363,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def edit_tax_name(self, bill_id, tax_id, user_id, name):
         try:
             self.cursor.execute("""\
@@ -500,6 +1389,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def edit_tax_amt(self, bill_id, tax_id, user_id, amt):
         try:
             self.cursor.execute("""\
@@ -525,6 +1415,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def delete_tax(self, bill_id, tax_id, user_id):
         try:
             self.cursor.execute("""\
@@ -550,14 +1441,15 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_read
     def get_sharers(self, bill_id):
         try:
-            self.cursor.execute("""\
+            self.execute_prepared('get_sharers', """\
                 SELECT bs.item_id, u.id, u.username,
                     u.first_name, u.last_name
                 FROM bill_shares bs
                 INNER JOIN users u ON u.id = bs.user_id
-                WHERE bs.bill_id = %s
+                WHERE bs.bill_id = $1
                 AND NOT bs.is_deleted
                 ORDER BY bs.created_at
             """, (bill_id,)
@@ -568,11 +1460,12 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def toggle_bill_share(self, bill_id, item_id, user_id):
         try:
-            self.cursor.execute("""\
+            self.execute_prepared('toggle_bill_share', """\
                 INSERT INTO bill_shares (bill_id, item_id, user_id)
-                    VALUES(%s, %s, %s)
+                    VALUES($1, $2, $3)
                 ON CONFLICT(user_id, bill_id, item_id) DO UPDATE SET
                     is_deleted = NOT bill_shares.is_deleted
                 RETURNING id;
@@ -586,6 +1479,7 @@ class Transaction:
             self.is_error = True
             raise e
 
+    @bill_write
     def toggle_all_bill_shares(self, bill_id, user_id):
         try:
             self.cursor.execute("""\
@@ -624,12 +1518,12 @@ class Transaction:
 
     def has_bill_share(self, bill_id, item_id, user_id):
         try:
-            self.cursor.execute("""\
+            self.execute_prepared('has_bill_share', """\
                 SELECT id from bill_shares
-                    WHERE bill_id =  %s
-                        AND item_id = %s
-                        AND user_id = %s
-                        AND is_deleted = FALSE;
+                    WHERE bill_id =  $1
+                        AND item_id = $2
+                        AND user_id = $3
+                        AND is_deleted = FALSE
             """, (bill_id, item_id, user_id)
             )
 
@@ -642,203 +1536,345 @@ class Transaction:
             self.is_error = True
             raise e
 
-    def add_debtors(self, bill_id, creditor_id, debtors):
+    @bill_write
+    def close_bill_with_debtors(self, bill_id, creditor_id, debtors, d_type):
+        """\
+        Closes the bill and adds its debts with their first payments in one
+        statement. The creditor's own debt is paid; the rest are unpaid.
+        """
         try:
-            if len(debtors) < 1:
-                return
-
-            query = """\
-                INSERT INTO debts (debtor_id, creditor_id, bill_id,
-                    original_amt)
-                VALUES
-            """
-            sql_vars = []
-            values = []
-            for debtor_id, amt in debtors.items():
-                sql_vars.append(" (%s, %s, %s, %s)")
-                values.extend([debtor_id, creditor_id, bill_id, amt])
-            query += ','.join(sql_vars)
-            query += """ ON CONFLICT(debtor_id, creditor_id, bill_id) DO NOTHING
-                        RETURNING id"""
-            self.cursor.execute(query, tuple(values))
+            debtor_ids = list(debtors.keys())
+            self.cursor.execute("""\
+                WITH closed AS (
+                    UPDATE bills SET closed_at = NOW()
+                    WHERE id = %(bill_id)s
+                    AND closed_at IS NULL
+                    RETURNING id
+                ), debt AS (
+                    INSERT INTO debts (debtor_id, creditor_id, bill_id,
+                        original_amt)
+                    SELECT v.debtor_id, %(creditor_id)s, c.id, v.amt
+                    FROM closed c
+                    CROSS JOIN UNNEST(
+                        %(debtor_ids)s::INTEGER[], %(amts)s::REAL[]
+                    ) AS v(debtor_id, amt)
+                    ON CONFLICT(debtor_id, creditor_id, bill_id) DO NOTHING
+                    RETURNING id, debtor_id, original_amt
+                ), payment AS (
+                    INSERT INTO payments (type, debt_id, amount)
+                    SELECT %(type)s, d.id, d.original_amt
+                    FROM debt d
+                    WHERE ABS(d.original_amt) >= %(epsilon)s
+                    RETURNING id, debt_id, amount
+                ), event AS (
+                    -- new -> confirmed for the creditor: the amount is paid
+                    INSERT INTO payment_events (payment_id, debt_id, status,
+                        paid_delta, pending_delta, forced_delta)
+                    SELECT p.id, p.debt_id,
+                        CASE WHEN d.debtor_id = %(creditor_id)s
+                            THEN %(confirmed)s ELSE %(withdrawn)s END,
+                        CASE WHEN d.debtor_id = %(creditor_id)s
+                            THEN p.amount ELSE 0 END,
+                        0, 0
+                    FROM payment p
+                    INNER JOIN debt d ON d.id = p.debt_id
+                )
+                SELECT id FROM debt
+            """, {
+                'bill_id': bill_id,
+                'creditor_id': creditor_id,
+                'debtor_ids': debtor_ids,
+                'amts': [debtors[debtor_id] for debtor_id in debtor_ids],
+                'type': d_type,
+                'confirmed': const.PAY_STATUS_CONFIRMED,
+                'withdrawn': const.PAY_STATUS_WITHDRAWN,
+                'epsilon': AMOUNT_EPSILON,
+            })
 
             if len(self.cursor.fetchall()) != len(debtors):
-                raise Exception('Error in debtor adding')
+                raise Exception('Error in closing bill')
         except Exception as e:
             self.is_error = True
             raise e
 
+    @payment_write
     def add_payment(self, d_type, debt_id, amt, comments=None,
                     auto_confirm=False, is_deleted=False):
         try:
-            query = """\
-                INSERT INTO payments (type, debt_id, amount,
-                    is_deleted, confirmed_at)
-                VALUES
-            """
-            if auto_confirm:
-                query += " (%s, %s, %s, %s, NOW())"
-            else:
-                query += " (%s, %s, %s, %s, NULL)"
-
-            self.cursor.execute(query, (d_type, debt_id, amt, is_deleted))
+            self.cursor.execute("""\
+                INSERT INTO payments (type, debt_id, amount, comments)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+            """, (d_type, debt_id, amt, comments)
+            )
+            payment_id = self.cursor.fetchone()[0]
+            self.add_payment_event(
+                payment_id, debt_id, amt, None,
+                self.get_new_status(auto_confirm, is_deleted)
+            )
+            return payment_id
         except Exception as e:
             self.is_error = True
             raise e
 
+    @payment_write
     def add_payment_by_bill(self, d_type, bill_id, creditor_id, debtor_id,
                             auto_confirm=False, is_deleted=False):
+        """\
+        Withdraws the debtor's pending payments to the creditor for the
+        bill if there are any. Otherwise every unpaid debt gets a payment
+        in the new status, reusing a withdrawn payment of the same amount.
+        """
         try:
-            """
-            row lock on debts table acquired.
-            ensures state in the remaining code is consistent as
-            lock is not released until request is finished
-            """
-            remaining_debts = self.get_remaining_debt_by_bill(
-                bill_id, debtor_id, creditor_id
+            paid_factor, pending_delta, forced_delta = self.get_status_deltas(
+                1, None, self.get_new_status(auto_confirm, is_deleted)
             )
-            if len(remaining_debts) < 1:
-                return
-
-            pending = self.get_pending_payments(bill_id, creditor_id)
-            if len(pending) > 0:
-                for pid, __, uid, __, __, __ in pending:
-                    if uid == debtor_id:
-                        self.cursor.execute("""\
-                            UPDATE payments SET is_deleted = TRUE
-                            WHERE id = %s
-                        """, (pid,))
-                        return
-
-            # get deleted payments
+            # The debts are locked by the first statement. The second one
+            # takes a new snapshot, so it sees payment events committed
+            # while waiting for the locks. Both are sent in one round trip.
             self.cursor.execute("""\
-                SELECT p.id, d.id
-                FROM payments p
-                INNER JOIN debts d ON d.id = p.debt_id
-                INNER JOIN users u ON u.id = d.debtor_id
-                WHERE d.bill_id = %s
-                AND d.creditor_id = %s
+                SELECT d.id
+                FROM debts d
+                WHERE d.bill_id = %(bill_id)s
+                AND d.debtor_id = %(debtor_id)s
+                AND d.creditor_id = %(creditor_id)s
                 AND d.is_deleted = FALSE
-                AND p.is_deleted = TRUE
-                AND p.confirmed_at IS NULL
+                ORDER BY d.id
                 FOR UPDATE;
-            """, (bill_id, creditor_id)
-            )
-
-            # each user can only have 1 pending payment
-            # for each debt in a bill
-            deleted = self.cursor.fetchall()
-
-            unadded = [d[0] for d in remaining_debts]
-            for debt_id, amt in remaining_debts:
-                for pay_id, pay_debt_id in deleted:
-                    if pay_debt_id == debt_id:
-                        query = """\
-                            UPDATE payments SET
-                                type=%s,
-                                debt_id=%s,
-                                amount=%s,
-                                is_deleted=%s
-                        """
-                        if auto_confirm:
-                            query += ", confirmed_at=NOW())"
-
-                        query += " WHERE id = %s"   
-                        self.cursor.execute(
-                            query,
-                            (d_type, debt_id, amt, is_deleted, pay_id)
-                        )
-                        unadded.remove(debt_id)
-
-            for debt_id, amt in remaining_debts:
-                if debt_id in unadded:
-                    query = """\
-                        INSERT INTO payments (type, debt_id, amount,
-                            is_deleted, confirmed_at)
-                        VALUES
-                    """
-                    if auto_confirm:
-                        query += " (%s, %s, %s, %s, NOW())"
-                    else:
-                        query += " (%s, %s, %s, %s, NULL)"
-
-                    self.cursor.execute(
-                        query,
-                        (d_type, debt_id, amt, is_deleted)
-                    )
 
+                WITH remaining AS (
+                    SELECT d.id, d.original_amt - ({}) AS amt
+                    FROM debts d
+                    {}
+                    WHERE d.bill_id = %(bill_id)s
+                    AND d.debtor_id = %(debtor_id)s
+                    AND d.creditor_id = %(creditor_id)s
+                    AND d.is_deleted = FALSE
+                ), payment AS (
+                    SELECT p.id, p.debt_id, p.amount, s.status
+                    FROM payments p
+                    INNER JOIN remaining r ON r.id = p.debt_id
+                    {}
+                    WHERE ABS(r.amt) >= %(epsilon)s
+                    AND s.status IN (%(withdrawn)s, %(pending)s)
+                ), is_pending AS (
+                    SELECT EXISTS (
+                        SELECT 1 FROM payment WHERE status = %(pending)s
+                    ) AS value
+                ), withdrawal AS (
+                    -- pending -> withdrawn: 1 less pending
+                    INSERT INTO payment_events (payment_id, debt_id, status,
+                        paid_delta, pending_delta, forced_delta)
+                    SELECT id, debt_id, %(withdrawn)s, 0, -1, 0
+                    FROM payment
+                    WHERE status = %(pending)s
+                ), reusable AS (
+                    SELECT DISTINCT ON (p.debt_id) p.id, p.debt_id, p.amount
+                    FROM payment p
+                    INNER JOIN remaining r ON r.id = p.debt_id
+                    WHERE p.status = %(withdrawn)s
+                    AND ABS(p.amount - r.amt) < %(epsilon)s
+                    ORDER BY p.debt_id, p.id DESC
+                ), reuse AS (
+                    INSERT INTO payment_events (payment_id, debt_id, status,
+                        paid_delta, pending_delta, forced_delta)
+                    SELECT id, debt_id, %(status)s, amount * %(paid_factor)s,
+                        %(pending_delta)s, %(forced_delta)s
+                    FROM reusable
+                    WHERE %(status)s <> %(withdrawn)s
+                    AND NOT (SELECT value FROM is_pending)
+                ), added AS (
+                    INSERT INTO payments (type, debt_id, amount)
+                    SELECT %(type)s, r.id, r.amt
+                    FROM remaining r
+                    WHERE ABS(r.amt) >= %(epsilon)s
+                    AND r.id NOT IN (SELECT debt_id FROM reusable)
+                    AND NOT (SELECT value FROM is_pending)
+                    RETURNING id, debt_id, amount
+                )
+                INSERT INTO payment_events (payment_id, debt_id, status,
+                    paid_delta, pending_delta, forced_delta)
+                SELECT id, debt_id, %(status)s, amount * %(paid_factor)s,
+                    %(pending_delta)s, %(forced_delta)s
+                FROM added
+            """.format(DEBT_PAID_AMOUNT, DEBT_BALANCE_JOIN,
+                       PAYMENT_STATUS_JOIN), {
+                'bill_id': bill_id,
+                'debtor_id': debtor_id,
+                'creditor_id': creditor_id,
+                'type': d_type,
+                'status': self.get_new_status(auto_confirm, is_deleted),
+                'paid_factor': paid_factor,
+                'pending_delta': pending_delta,
+                'forced_delta': forced_delta,
+                'withdrawn': const.PAY_STATUS_WITHDRAWN,
+                'pending': const.PAY_STATUS_PENDING,
+                'epsilon': AMOUNT_EPSILON,
+            })
         except Exception as e:
             self.is_error = True
             raise e
 
-    def get_remaining_debt_by_bill(self, bill_id, debtor_id, creditor_id):
-        self.cursor.execute("""\
-            SELECT d.id, d.original_amt, p.amount, p.confirmed_at,
-            COALESCE(p.is_deleted, FALSE)
-            FROM debts d
-            LEFT JOIN payments p ON p.debt_id = d.id
-            WHERE d.bill_id = %s
-            AND d.debtor_id = %s
-            AND d.creditor_id = %s
-            AND d.is_deleted = FALSE
-            ORDER BY d.id
-            FOR UPDATE OF d
-        """, (bill_id, debtor_id, creditor_id)
-        )
+    @staticmethod
+    def get_new_status(auto_confirm, is_deleted):
+        if is_deleted:
+            return const.PAY_STATUS_WITHDRAWN
+        if auto_confirm:
+            return const.PAY_STATUS_CONFIRMED
+        return const.PAY_STATUS_PENDING
 
-        results = self.cursor.fetchall()
-        final_amts = []
-        prev_d_id = None
-        final_amt = 0
-        for i, result in enumerate(results):
-            d_id, d_amt, p_amt, confirmed_at, is_deleted = result
-            if prev_d_id is None:
-                prev_d_id = d_id
-                final_amt = d_amt
+    @staticmethod
+    def get_status_deltas(amt, prev_status, status):
+        """\
+        Change in a debt's (paid amount, pending count, forced count) when
+        one of its payments goes from prev_status to status. prev_status
+        is None for a new payment.
+        """
+        def counts(s):
+            return (
+                amt if s in PAID_STATUSES else 0,
+                1 if s == const.PAY_STATUS_PENDING else 0,
+                1 if s == const.PAY_STATUS_FORCED else 0
+            )
 
-            if prev_d_id != d_id:
-                if not math.isclose(final_amt, 0):
-                    final_amts.append((prev_d_id, final_amt))
-                prev_d_id = d_id
-                final_amt = d_amt
+        return tuple(
+            new - old for new, old in zip(counts(status), counts(prev_status))
+        )
 
-            if confirmed_at is not None and not is_deleted:
-                final_amt -= p_amt
+    def add_payment_event(self, payment_id, debt_id, amt,
+                          prev_status, status):
+        paid_delta, pending_delta, forced_delta = self.get_status_deltas(
+            amt, prev_status, status
+        )
+        self.execute_prepared(
+            'add_payment_event',
+            """\
+            INSERT INTO payment_events (payment_id, debt_id, status,
+                paid_delta, pending_delta, forced_delta)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            """,
+            (payment_id, debt_id, status,
+             paid_delta, pending_delta, forced_delta)
+        )
 
-            if i >= len(results) - 1:
-                if not math.isclose(final_amt, 0):
-                    final_amts.append((prev_d_id, final_amt))
+    @payment_write
+    def set_payment_status(self, payment_id, status, from_statuses=None):
+        """\
+        Appends a status change for the payment. The debt is locked first
+        so that changes to its payments are applied one at a time.
+        """
+        self.cursor.execute("""\
+            SELECT d.id
+            FROM debts d
+            INNER JOIN payments p ON p.debt_id = d.id
+            WHERE p.id = %s
+            FOR UPDATE OF d
+        """, (payment_id,)
+        )
+        self.cursor.execute("""\
+            SELECT p.debt_id, p.amount, s.status
+            FROM payments p
+            {}
+            WHERE p.id = %s
+        """.format(PAYMENT_STATUS_JOIN), (payment_id,)
+        )
+        rows = self.cursor.fetchall()
+        if len(rows) != 1:
+            raise Exception('Less or more than 1 payment found')
+
+        debt_id, amt, prev_status = rows[0]
+        if from_statuses is not None and prev_status not in from_statuses:
+            raise Exception(
+                'Payment {} has status {}'.format(payment_id, prev_status)
+            )
 
-        return final_amts
+        self.add_payment_event(payment_id, debt_id, amt, prev_status, status)
 
+    @bill_read
     def get_debts(self, bill_id):
+        """\
+        One row per debt, with its paid amount and whether it has pending
+        and force confirmed payments.
+        """
         try:
             self.cursor.execute("""\
-                SELECT a.id, a.debt_amt,
-                    a.debtor_id, u1.first_name, u1.last_name, u1.username,
-                    a.creditor_id, u2.first_name, u2.last_name, u2.username,
-                    p.amount, p.created_at, p.confirmed_at,
-                    COALESCE(p.is_deleted, FALSE), p.is_forced
-                FROM
-                    (
-                        SELECT d.id, d.debtor_id, d.creditor_id,
-                            SUM(d.original_amt) AS debt_amt
-                        FROM debts d
-                        WHERE d.bill_id = %s
-                        AND d.is_deleted = FALSE
-                        GROUP BY d.id, d.debtor_id, d.creditor_id
-                    ) AS a
-                INNER JOIN users u1 ON u1.id = a.debtor_id
-                INNER JOIN users u2 ON u2.id = a.creditor_id
-                LEFT JOIN payments p ON p.debt_id = a.id
-                ORDER BY a.creditor_id, a.debtor_id
-            """, (bill_id,)
+                SELECT d.id, d.original_amt,
+                    d.debtor_id, u1.first_name, u1.last_name, u1.username,
+                    d.creditor_id, u2.first_name, u2.last_name, u2.username,
+                    {}, {}, {}
+                FROM debts d
+                INNER JOIN users u1 ON u1.id = d.debtor_id
+                INNER JOIN users u2 ON u2.id = d.creditor_id
+                {}
+                WHERE d.bill_id = %s
+                AND d.is_deleted = FALSE
+                ORDER BY d.creditor_id, d.debtor_id
+            """.format(DEBT_PAID_AMOUNT, DEBT_IS_PENDING, DEBT_IS_FORCED,
+                       DEBT_BALANCE_JOIN), (bill_id,)
             )
             return self.cursor.fetchall()
         except Exception as e:
             self.is_error = True
             raise e
 
+    def snapshot_debt_balances(self):
+        """\
+        Folds payment events into debt_balances. Only events appended by
+        transactions older than every transaction still running are
+        folded, so no event can later commit below a snapshot's
+        event_txid. Debts locked by a payment write are left for the next
+        fold. Skipped while another fold or a bill move is running.
+        """
+        try:
+            self.cursor.execute(
+                "SELECT pg_try_advisory_xact_lock(%s)", (SNAPSHOT_LOCK_ID,)
+            )
+            if not self.cursor.fetchone()[0]:
+                return 0
+
+            # The horizon comes from the snapshot of this statement, which
+            # sees every event appended below it
+            self.cursor.execute("""\
+                WITH horizon AS (
+                    SELECT txid_snapshot_xmin(txid_current_snapshot()) AS txid
+                ), tail AS (
+                    SELECT e.debt_id, SUM(e.paid_delta) AS paid_amount,
+                        SUM(e.pending_delta) AS pending_count,
+                        SUM(e.forced_delta) AS forced_count
+                    FROM payment_events e
+                    CROSS JOIN horizon h
+                    LEFT JOIN debt_balances b ON b.debt_id = e.debt_id
+                    WHERE e.txid >= COALESCE(b.event_txid, 0)
+                    AND e.txid < h.txid
+                    GROUP BY e.debt_id
+                ), unlocked AS (
+                    SELECT d.id FROM debts d
+                    WHERE d.id IN (SELECT debt_id FROM tail)
+                    FOR KEY SHARE SKIP LOCKED
+                )
+                INSERT INTO debt_balances (debt_id, event_txid, paid_amount,
+                    pending_count, forced_count)
+                SELECT t.debt_id, h.txid, t.paid_amount, t.pending_count,
+                    t.forced_count
+                FROM tail t
+                INNER JOIN unlocked u ON u.id = t.debt_id
+                CROSS JOIN horizon h
+                ON CONFLICT (debt_id) DO UPDATE SET
+                    event_txid = EXCLUDED.event_txid,
+                    paid_amount =
+                        debt_balances.paid_amount + EXCLUDED.paid_amount,
+                    pending_count =
+                        debt_balances.pending_count + EXCLUDED.pending_count,
+                    forced_count =
+                        debt_balances.forced_count + EXCLUDED.forced_count,
+                    updated_at = NOW()
+                RETURNING debt_id
+            """)
+            return len(self.cursor.fetchall())
+        except Exception as e:
+            self.is_error = True
+            raise e
+
     def get_pending_payments(self, bill_id, creditor_id):
         try:
             self.cursor.execute("""\
@@ -846,13 +1882,14 @@ class Transaction:
                 FROM payments p
                 INNER JOIN debts d ON d.id = p.debt_id
                 INNER JOIN users u ON u.id = d.debtor_id
+                {}
                 WHERE d.bill_id = %s
                 AND d.creditor_id = %s
                 AND d.is_deleted = FALSE
-                AND p.is_deleted = FALSE
-                AND p.confirmed_at IS NULL
-                FOR UPDATE;
-            """, (bill_id, creditor_id)
+                AND s.status = %s
+                {};
+            """.format(PAYMENT_STATUS_JOIN, self.row_lock('d')),
+                (bill_id, creditor_id, const.PAY_STATUS_PENDING)
             )
 
             return self.cursor.fetchall()
@@ -867,13 +1904,14 @@ class Transaction:
                 FROM payments p
                 INNER JOIN debts d ON d.id = p.debt_id
                 INNER JOIN users u ON u.id = d.debtor_id
+                {}
                 WHERE d.bill_id = %s
                 AND d.creditor_id = %s
                 AND d.is_deleted = FALSE
-                AND p.is_deleted = TRUE
-                AND p.confirmed_at IS NULL
-                FOR UPDATE;
-            """, (bill_id, creditor_id)
+                AND s.status = %s
+                {};
+            """.format(PAYMENT_STATUS_JOIN, self.row_lock('d')),
+                (bill_id, creditor_id, const.PAY_STATUS_WITHDRAWN)
             )
 
             return self.cursor.fetchall()
@@ -903,36 +1941,74 @@ class Transaction:
 
     def confirm_payment(self, payment_id):
         try:
+            self.set_payment_status(
+                payment_id,
+                const.PAY_STATUS_CONFIRMED,
+                from_statuses=(const.PAY_STATUS_PENDING,)
+            )
+        except Exception as e:
+            self.is_error = True
+            raise e
+
+    @bill_write
+    def confirm_payments(self, bill_id, creditor_id, payment_ids):
+        """\
+        Confirms the pending payments among payment_ids owed to creditor_id
+        in one insert and returns the ids confirmed.
+        """
+        try:
+            if len(payment_ids) < 1:
+                return []
+
+            # Locked first so the insert's snapshot sees any withdrawal
+            # that committed while waiting for the locks
             self.cursor.execute("""\
-                UPDATE payments SET confirmed_at = NOW()
-                WHERE id = %s
-                RETURNING id
-            """, (payment_id,)
+                SELECT d.id
+                FROM debts d
+                INNER JOIN payments p ON p.debt_id = d.id
+                WHERE p.id = ANY(%s)
+                ORDER BY d.id
+                FOR UPDATE OF d
+            """, (list(payment_ids),)
             )
-            rows = self.cursor.fetchall()
-            if len(rows) != 1:
-                raise Exception('Less or more than 1 confirmed')
+            # pending -> confirmed: the amount is paid, 1 less pending
+            self.cursor.execute("""\
+                INSERT INTO payment_events (payment_id, debt_id, status,
+                    paid_delta, pending_delta, forced_delta)
+                SELECT p.id, p.debt_id, %s, p.amount, -1, 0
+                FROM payments p
+                INNER JOIN debts d ON d.id = p.debt_id
+                {}
+                WHERE p.id = ANY(%s)
+                AND d.bill_id = %s
+                AND d.creditor_id = %s
+                AND d.is_deleted = FALSE
+                AND s.status = %s
+                RETURNING payment_id
+            """.format(PAYMENT_STATUS_JOIN),
+                (const.PAY_STATUS_CONFIRMED, list(payment_ids), bill_id,
+                 creditor_id, const.PAY_STATUS_PENDING)
+            )
+            return [row[0] for row in self.cursor.fetchall()]
         except Exception as e:
             self.is_error = True
             raise e
 
     def force_confirm_payment(self, payment_id):
         try:
-            self.cursor.execute("""\
-                UPDATE payments SET is_deleted = FALSE, confirmed_at = NOW(),
-                is_forced = TRUE
-                WHERE id = %s
-                RETURNING id
-            """, (payment_id,)
+            self.set_payment_status(
+                payment_id,
+                const.PAY_STATUS_FORCED,
+                from_statuses=(
+                    const.PAY_STATUS_WITHDRAWN,
+                    const.PAY_STATUS_PENDING
+                )
             )
-            rows = self.cursor.fetchall()
-            if len(rows) != 1:
-                raise Exception('Less or more than 1 confirmed')
         except Exception as e:
             self.is_error = True
             raise e
 
     @staticmethod
     def generate_id(length):
-        guid = str(uuid.uuid1())
-        return guid.replace('-', '')[:length]
+        # Random, unlike uuid1 whose leading digits are the time
+        return uuid.uuid4().hex[:length]
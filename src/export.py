@@ -0,0 +1,18 @@
+import gzip
+
+EXPORT_FILENAME = 'whopay_bills.jsonl.gz'
+
+
+def write_bill_export(trans, user_id, fileobj):
+    """\
+    Writes every bill of user_id to fileobj as gzipped JSON Lines, one bill
+    per line, as the bills are fetched. Returns the number of bills.
+    """
+    count = 0
+    with gzip.GzipFile(filename=EXPORT_FILENAME[:-3], mode='wb',
+                       fileobj=fileobj) as f:
+        for bill in trans.iter_bill_exports(user_id):
+            f.write(bill.encode('utf-8'))
+            f.write(b'\n')
+            count += 1
+    return count
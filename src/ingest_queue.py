@@ -0,0 +1,135 @@
+import sqlite3
+import threading
+import queue
+import json
+import time
+import logging
+
+
+class DurableQueue:
+    """\
+    Append-only SQLite queue sitting between webhook ingestion and the
+    dispatcher. put() returns once the update is on disk; writes from
+    concurrent requests are grouped so a single fsync covers a batch.
+
+    Updates are handed to `handoff(row_id, payload)` after they are
+    stored and stay in the queue until ack(row_id), so anything not
+    acknowledged is replayed on the next startup (at-least-once).
+    """
+    def __init__(self, path, handoff, batch_size=200, batch_interval=0.01,
+                 max_attempts=3):
+        self.path = path
+        self.handoff = handoff
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_attempts = max_attempts
+        self.commands = queue.Queue()
+        self.ready = threading.Event()
+        self.writer = threading.Thread(
+            target=self.run,
+            name='ingest_queue',
+            daemon=True
+        )
+
+    def start(self):
+        self.writer.start()
+        self.ready.wait()
+
+    def put(self, payload, timeout=10):
+        done = threading.Event()
+        result = {}
+        self.commands.put(('put', json.dumps(payload), done, result))
+        if not done.wait(timeout):
+            raise Exception('Timed out waiting for ingest queue')
+        if result.get('error') is not None:
+            raise result['error']
+
+    def ack(self, row_id):
+        if row_id is not None:
+            self.commands.put(('ack', row_id, None, None))
+
+    def run(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        conn.execute("""\
+            CREATE TABLE IF NOT EXISTS updates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL
+            )
+        """)
+        self.replay(conn)
+        self.ready.set()
+
+        while True:
+            batch = [self.commands.get()]
+            deadline = time.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.commands.get(
+                        timeout=max(0, deadline - time.time())
+                    ))
+                except queue.Empty:
+                    break
+
+            self.write_batch(conn, batch)
+
+    def write_batch(self, conn, batch):
+        stored = []
+        error = None
+        try:
+            conn.execute('BEGIN')
+            for command, value, done, result in batch:
+                if command == 'put':
+                    cur = conn.execute("""\
+                        INSERT INTO updates (payload, enqueued_at)
+                            VALUES (?, ?)
+                    """, (value, time.time()))
+                    stored.append((cur.lastrowid, value))
+                elif command == 'ack':
+                    conn.execute("""\
+                        DELETE FROM updates WHERE id = ?
+                    """, (value,))
+            conn.execute('COMMIT')
+        except Exception as e:
+            logging.exception('write_batch')
+            conn.execute('ROLLBACK')
+            stored = []
+            error = e
+
+        for command, value, done, result in batch:
+            if done is not None:
+                result['error'] = error
+                done.set()
+
+        for row_id, payload in stored:
+            self.dispatch(row_id, payload)
+
+    def replay(self, conn):
+        """\
+        Hands over updates left unacknowledged by the previous run.
+        Updates that have already been retried max_attempts times are
+        dropped so a poison update cannot block startup forever.
+        """
+        conn.execute('BEGIN')
+        conn.execute("""\
+            DELETE FROM updates WHERE attempts >= ?
+        """, (self.max_attempts,))
+        conn.execute('UPDATE updates SET attempts = attempts + 1')
+        rows = conn.execute("""\
+            SELECT id, payload FROM updates ORDER BY id
+        """).fetchall()
+        conn.execute('COMMIT')
+
+        if len(rows) > 0:
+            logging.info('Replaying {} updates'.format(len(rows)))
+        for row_id, payload in rows:
+            self.dispatch(row_id, payload)
+
+    def dispatch(self, row_id, payload):
+        try:
+            self.handoff(row_id, json.loads(payload))
+        except Exception as e:
+            logging.exception('dispatch')
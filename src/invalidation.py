@@ -0,0 +1,71 @@
+import psycopg2
+import psycopg2.extensions
+import threading
+import logging
+import select
+import cache
+
+# '<origin id> <cache key>', sent by Transaction.commit
+CACHE_CHANGED = 'cache_changed'
+
+
+class InvalidationListener:
+    """\
+    LISTENs on the primary for changes committed by other processes and
+    evicts the matching entries from this process' cache. Only needed when
+    the cache is not shared.
+    """
+    def __init__(self, dsn, timeout=5, retry_delay=5):
+        self.dsn = dsn
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run,
+            name='invalidation',
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except Exception as e:
+                logging.exception('InvalidationListener')
+            # Changes made while disconnected were never heard of
+            if not cache.is_shared():
+                cache.backend.clear()
+            self.stopped.wait(self.retry_delay)
+
+    def listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+            )
+            cursor = conn.cursor()
+            cursor.execute('LISTEN {};'.format(CACHE_CHANGED))
+            while not self.stopped.is_set():
+                if select.select([conn], [], [], self.timeout) == \
+                        ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self.handle(notify.channel, notify.payload)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def handle(channel, payload):
+        if channel == CACHE_CHANGED:
+            origin_id, key = payload.split(' ', 1)
+            if origin_id != cache.ORIGIN_ID:
+                cache.delete_value(key)
@@ -12,13 +12,19 @@ if __name__ == '__main__':
           settings.DB_NAME,
           settings.DB_PORT,
           settings.DB_USER,
-          settings.DB_PASS
+          settings.DB_PASS,
+          replicas=settings.REPLICA_URLS,
+          max_replica_lag=settings.REPLICA_MAX_LAG,
+          pool_size=settings.DB_POOL_SIZE
       )
       bot = TelegramBot(settings.TOKEN,
                         settings.APP_NAME,
                         settings.PORT,
                         db,
-                        settings.IS_PROD)
+                        settings.IS_PROD,
+                        ingest_queue_path=settings.INGEST_QUEUE_PATH,
+                        num_workers=settings.WORKER_PROCESSES,
+                        cache_url=settings.CACHE_URL)
     except Exception as e:
         logging.exception()
 
@@ -0,0 +1,72 @@
+from database import Transaction
+import threading
+import time
+import logging
+
+
+class Maintenance:
+    """\
+    Runs periodic database jobs on a background thread. Each run of a job
+    gets its own transaction on the primary, which is passed to the job.
+    """
+    def __init__(self, db, tick=5, batch_pause=0.5):
+        self.db = db
+        self.tick = tick
+        self.batch_pause = batch_pause
+        self.jobs = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def register(self, name, interval, func, is_batched=False):
+        """\
+        A batched job returns how many rows it processed and is run again,
+        in a new transaction, until it returns 0.
+        """
+        self.jobs.append({
+            'name': name,
+            'interval': interval,
+            'func': func,
+            'is_batched': is_batched,
+            'next_run': time.monotonic() + interval
+        })
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run,
+            name='maintenance',
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            now = time.monotonic()
+            for job in self.jobs:
+                if job['next_run'] > now:
+                    continue
+                job['next_run'] = now + job['interval']
+                self.run_job(job)
+
+    def run_job(self, job):
+        try:
+            total = 0
+            while not self.stopped.is_set():
+                conn = self.db.get_connection()
+                with Transaction(conn) as trans:
+                    result = job['func'](trans)
+                if not job['is_batched']:
+                    logging.info('{}: {}'.format(job['name'], result))
+                    return
+
+                total += result
+                if result < 1:
+                    break
+                logging.info('{}: {} so far'.format(job['name'], total))
+                # Leaves room for the bot's own transactions between batches
+                self.stopped.wait(self.batch_pause)
+            logging.info('{}: {}'.format(job['name'], total))
+        except Exception as e:
+            logging.exception(job['name'])
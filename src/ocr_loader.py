@@ -0,0 +1,30 @@
+import importlib
+import threading
+
+# Modules pulled in by OCR.py. None of them should be loaded by the text path.
+OCR_MODULES = ('OCR', 'cv2', 'numpy', 'scipy', 'PIL', 'tesserocr')
+
+_lock = threading.Lock()
+_module = None
+
+
+def get_ocr():
+    """\
+    Imports the OCR stack on first use. Importing OCR.py loads cv2, scipy,
+    numpy, PIL and tesserocr, so it must never be imported at startup.
+    """
+    global _module
+    if _module is not None:
+        return _module
+
+    with _lock:
+        if _module is None:
+            _module = importlib.import_module('OCR')
+    return _module
+
+
+def read_receipt(image_path):
+    ocr = get_ocr()
+    image = ocr.Image.open(image_path)
+    __, results = ocr.read_receipt(image)
+    return [text for text, __ in results]
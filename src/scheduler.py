@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import threading
+import logging
+
+
+def get_update_key(update):
+    """\
+    Updates with the same key are run one after the other: the chat the
+    update belongs to, or the sender for updates that have no chat (inline
+    queries and their chosen results, callbacks from inline messages).
+    Matches the id worker processes are sharded by, so a chat's updates
+    run in arrival order.
+    """
+    if update.message is not None:
+        return update.message.chat_id
+
+    cbq = update.callback_query
+    if cbq is not None:
+        if cbq.message is not None:
+            return cbq.message.chat_id
+        return cbq.from_user.id
+
+    if update.inline_query is not None:
+        return update.inline_query.from_user.id
+
+    if update.chosen_inline_result is not None:
+        return update.chosen_inline_result.from_user.id
+
+    return None
+
+
+class OrderedScheduler:
+    """\
+    Runs tasks on a shared thread pool while keeping tasks with the same
+    key in submission order: a key has at most one task running, so rapid
+    taps in a chat no longer race each other for the same row locks.
+    Different keys run in parallel. At most max_pending tasks (including
+    the running one) are held per key, so per chat; submitting another
+    waits until the key's oldest task is done.
+    """
+    def __init__(self, workers=32, max_pending=20):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # Notified whenever a task is done and its key has room again
+        self.has_room = threading.Condition(self.lock)
+        self.pending = {}
+
+    def submit(self, key, func, *args, **kwargs):
+        """\
+        Blocks the caller while the key has max_pending tasks, which holds
+        back the updates behind it instead of dropping or reordering them.
+        """
+        with self.lock:
+            while len(self.pending.get(key, ())) >= self.max_pending:
+                self.has_room.wait()
+            tasks = self.pending.get(key)
+            is_idle = tasks is None
+            if is_idle:
+                tasks = collections.deque()
+                self.pending[key] = tasks
+            tasks.append((func, args, kwargs))
+
+        if is_idle:
+            self.executor.submit(self.run, key)
+
+    def run(self, key):
+        with self.lock:
+            tasks = self.pending[key]
+
+        while True:
+            # The running task stays at the head of the deque until it is
+            # done, which marks the key as busy
+            with self.lock:
+                func, args, kwargs = tasks[0]
+
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logging.exception('OrderedScheduler')
+
+            with self.lock:
+                tasks.popleft()
+                self.has_room.notify_all()
+                if len(tasks) == 0:
+                    del self.pending[key]
+                    return
@@ -15,6 +15,14 @@ class EnvSettings:
         EnvSettings.PORT = int(environ.get('PORT', '5000'))
         EnvSettings.APP_NAME = environ.get("APP_NAME")
         EnvSettings.IS_PROD = int(environ.get("IS_PROD"))
+        EnvSettings.INGEST_QUEUE_PATH = environ.get(
+            'INGEST_QUEUE_PATH', 'ingest_queue.db'
+        )
+        # 0 handles updates in this process, N > 0 shards them by chat id
+        # across N worker processes
+        EnvSettings.WORKER_PROCESSES = int(
+            environ.get('WORKER_PROCESSES', '0')
+        )
 
         if EnvSettings.IS_PROD:
             url = urlparse.urlparse(environ['DATABASE_URL'])
@@ -29,3 +37,20 @@ class EnvSettings:
             EnvSettings.DB_PORT = environ.get("DB_PORT")
             EnvSettings.DB_HOST = environ.get("DB_HOST")
             EnvSettings.DB_PASS = environ.get("DB_PASS")
+
+        # Connections per db. Handlers run on 32 scheduler threads and the
+        # maintenance jobs on one more; callers wait when all are in use
+        EnvSettings.DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', '40'))
+
+        # Comma separated postgresql:// urls of read replicas
+        EnvSettings.REPLICA_URLS = [
+            url.strip() for url in environ.get('REPLICA_URLS', '').split(',')
+            if len(url.strip()) > 0
+        ]
+        EnvSettings.REPLICA_MAX_LAG = float(
+            environ.get('REPLICA_MAX_LAG', '5')
+        )
+
+        # redis:// url of the cache shared by all processes, in-process
+        # caches if unset
+        EnvSettings.CACHE_URL = environ.get('CACHE_URL')
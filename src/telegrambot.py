@@ -1,36 +1,192 @@
 from telegram.ext import Updater, Filters
 from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler
-from telegram.ext.dispatcher import run_async
+from telegram.ext import ChosenInlineResultHandler, TypeHandler
+from telegram import Update
 from telegram.parsemode import ParseMode
-from database import Transaction
+from database import Database, Transaction
 from action_handlers import create_bill_handler, manage_bill_handler, share_bill_handler
+from action_handlers.action_handler import registry
 import json
 import constants as const
 import logging
 import counter
 import datetime
+import threading
+import functools
+import webhook
+import workers
+import ingest_queue
+import scheduler
+import maintenance
+import cache
+import invalidation
+import tempfile
+import export
 
 
 PRIVATE_CHAT = 'private'
 
 
+def ordered(func):
+    """\
+    Runs the handler on the bot's OrderedScheduler instead of the
+    dispatcher thread. Updates of the same chat (or, without a chat, of
+    the same sender) are handled one at a time, in order. The dispatcher
+    waits while the chat already has max_pending updates queued.
+    """
+    @functools.wraps(func)
+    def wrapper(self, bot, update, *args, **kwargs):
+        self.scheduler.submit(
+            scheduler.get_update_key(update),
+            func, self, bot, update, *args, **kwargs
+        )
+    return wrapper
+
+
+def acknowledges(func):
+    """\
+    Acknowledges the update in the ingest queue once the handler is done,
+    whether or not it succeeded. Apply below @ordered.
+    """
+    @functools.wraps(func)
+    def wrapper(self, bot, update, *args, **kwargs):
+        try:
+            return func(self, bot, update, *args, **kwargs)
+        finally:
+            self.ack_update(update)
+    return wrapper
+
+
 class TelegramBot:
-    def __init__(self, token, app_name, port, db, is_prod):
+    def __init__(self, token, app_name, port, db, is_prod,
+                 ingest_queue_path='ingest_queue.db', num_workers=0,
+                 is_worker=False, cache_url=None):
         self.db = db
-        self.updater = Updater(token=token, workers=32)
+        self.cache_url = cache_url
+        cache.configure(cache_url)
+        if not cache.is_shared():
+            # Evicts what other processes change from the in-process cache
+            self.invalidation = invalidation.InvalidationListener(db.dsn)
+            self.invalidation.start()
+        self.ingest_queue = None
+        self.ack_queue = None
+        # Handlers run on the scheduler, not on the dispatcher's run_async
+        # threads
+        self.scheduler = scheduler.OrderedScheduler(
+            workers=32, max_pending=20
+        )
+        self.updater = Updater(token=token, workers=0)
         self.init_handlers(self.updater.dispatcher)
 
+        if is_worker:
+            return
+
+        self.start_maintenance()
         if is_prod:
-            self.updater.start_webhook(listen="0.0.0.0",
-                                       port=port,
-                                       url_path=token)
-            self.updater.bot.setWebhook("https://{}.herokuapp.com/{}".format(
-                app_name, token)
+            self.start_webhook(
+                token, app_name, port, ingest_queue_path, num_workers
             )
-            self.updater.idle()
         else:
             self.updater.start_polling()
 
+    def start_webhook(self, token, app_name, port, ingest_queue_path,
+                      num_workers):
+        if num_workers > 0:
+            # Updates are handled by worker processes sharded by chat id
+            worker_pool = workers.WorkerPool(
+                num_workers,
+                run_worker,
+                (token, self.db.get_config(), self.cache_url),
+                on_ack=lambda row_id: self.ingest_queue.ack(row_id)
+            )
+            worker_pool.start()
+            handoff = worker_pool.route
+        else:
+            self.start_dispatcher()
+            handoff = self.handoff_update
+
+        # Replays updates left unacknowledged by the previous run
+        self.ingest_queue = ingest_queue.DurableQueue(
+            ingest_queue_path,
+            handoff
+        )
+        self.ingest_queue.start()
+
+        server = webhook.WebhookServer(
+            ("0.0.0.0", port),
+            token,
+            self.ingest_queue
+        )
+        self.updater.bot.setWebhook("https://{}.herokuapp.com/{}".format(
+            app_name, token)
+        )
+        server.serve_forever()
+
+    def start_maintenance(self):
+        self.maintenance = maintenance.Maintenance(self.db)
+        # Folds the payment ledger into per-debt balance snapshots
+        self.maintenance.register(
+            'snapshot_debt_balances',
+            600,
+            Transaction.snapshot_debt_balances
+        )
+        # Deletes sessions abandoned for longer than SESSION_TTL
+        self.maintenance.register(
+            'reap_sessions',
+            3600,
+            Transaction.reap_sessions,
+            is_batched=True
+        )
+        # Deletes bills never marked done within DRAFT_BILL_TTL
+        self.maintenance.register(
+            'delete_draft_bills',
+            3600,
+            Transaction.delete_draft_bills,
+            is_batched=True
+        )
+        # Moves settled bills out of the hot tables after ARCHIVE_BILL_AGE
+        self.maintenance.register(
+            'archive_bills',
+            3600,
+            Transaction.archive_bills,
+            is_batched=True
+        )
+        self.maintenance.start()
+
+    def start_dispatcher(self):
+        dispatcher_thread = threading.Thread(
+            target=self.updater.dispatcher.start,
+            name='dispatcher'
+        )
+        dispatcher_thread.start()
+
+    def serve_worker(self, updates, acks):
+        self.ack_queue = acks
+        self.start_dispatcher()
+        while True:
+            item = updates.get()
+            if item is None:
+                break
+            row_id, payload = item
+            try:
+                self.handoff_update(row_id, payload)
+            except Exception as e:
+                logging.exception('serve_worker')
+                acks.put(row_id)
+        self.updater.dispatcher.stop()
+
+    def handoff_update(self, row_id, payload):
+        self.updater.update_queue.put(
+            webhook.to_update(row_id, payload, self.updater.bot)
+        )
+
+    def ack_update(self, update):
+        row_id = getattr(update, 'ingest_id', None)
+        if self.ingest_queue is not None:
+            self.ingest_queue.ack(row_id)
+        elif self.ack_queue is not None and row_id is not None:
+            self.ack_queue.put(row_id)
+
     def init_handlers(self, dispatcher):
         # Command handlers
         start_handler = CommandHandler('start', self.start, pass_args=True)
@@ -39,6 +195,8 @@ class TelegramBot:
         dispatcher.add_handler(help_handler)
         newbill_handler = CommandHandler('newbill', self.new_bill)
         dispatcher.add_handler(newbill_handler)
+        export_handler = CommandHandler('export', self.export_bills)
+        dispatcher.add_handler(export_handler)
         done_handler = CommandHandler('done', self.done)
         dispatcher.add_handler(done_handler)
         yes_handler = CommandHandler('yes', self.yes)
@@ -54,19 +212,39 @@ class TelegramBot:
         inline_handler = InlineQueryHandler(self.handle_inline)
         dispatcher.add_handler(inline_handler)
 
+        # Handle inline results sent, needs inline feedback on
+        chosen_inline_handler = ChosenInlineResultHandler(
+            self.handle_chosen_inline
+        )
+        dispatcher.add_handler(chosen_inline_handler)
+
         # Handle all replies
         message_handler = MessageHandler(Filters.all, self.handle_all_msg)
         dispatcher.add_handler(message_handler)
 
-    @run_async
+        # Acknowledges updates no handler above matched (edited messages,
+        # channel posts, chosen inline results...), so they are not
+        # replayed on every restart. Must stay last.
+        unhandled_handler = TypeHandler(Update, self.ack_unhandled)
+        dispatcher.add_handler(unhandled_handler)
+
+    def ack_unhandled(self, bot, update):
+        self.ack_update(update)
+
+    @ordered
+    @acknowledges
     def start(self, bot, update, args):
         # TODO: make command list screen
         if args is not None and len(args) == 1:
-            handler = manage_bill_handler.BillManagementHandler()
-            conn = self.db.get_connection()
-            data = {const.JSON_BILL_ID: args[0]}
-            with Transaction(conn) as trans:
-                msg = update.message
+            handler = self.get_action_handler(const.TYPE_MANAGE_BILL)
+            msg = update.message
+            with self.get_transaction(
+                msg.from_user.id, chat_id=msg.chat_id
+            ) as trans:
+                bill_id = trans.get_bill_id(args[0])
+                if bill_id is None:
+                    return self.send_help_msg(bot, update)
+                data = {const.JSON_BILL_ID: bill_id}
                 trans.reset_session(msg.chat_id, msg.from_user.id)
                 handler.execute(
                     bot,
@@ -78,17 +256,20 @@ class TelegramBot:
             return
         self.send_help_msg(bot, update)
 
-    @run_async
+    @ordered
+    @acknowledges
     def help(self, bot, update):
         self.send_help_msg(bot, update)
 
-    @run_async
+    @ordered
+    @acknowledges
     def new_bill(self, bot, update):
         # only allow private message
         try:
-            conn = self.db.get_connection()
             handler = self.get_action_handler(const.TYPE_CREATE_BILL)
-            with Transaction(conn) as trans:
+            user_id = update.message.from_user.id
+            chat_id = update.message.chat_id
+            with self.get_transaction(user_id, chat_id=chat_id) as trans:
                 handler.execute(
                     bot,
                     update,
@@ -98,19 +279,55 @@ class TelegramBot:
         except Exception as e:
             logging.exception('new_bill')
 
-    @run_async
+    @ordered
+    @acknowledges
+    def export_bills(self, bot, update):
+        try:
+            msg = update.message
+            if msg.chat.type != PRIVATE_CHAT:
+                return bot.sendMessage(
+                    chat_id=msg.chat_id,
+                    text='Send /export to me in a private chat.'
+                )
+
+            user = msg.from_user
+            with tempfile.TemporaryFile() as f:
+                # A read-only snapshot blocks no writes while it streams and
+                # may be served by a replica
+                with self.get_transaction(
+                    user.id, read_only=True, chat_id=msg.chat_id
+                ) as trans:
+                    count = export.write_bill_export(trans, user.id, f)
+                if count < 1:
+                    return bot.sendMessage(
+                        chat_id=msg.chat_id,
+                        text='You have no bills to export.'
+                    )
+                f.seek(0)
+                bot.sendDocument(
+                    chat_id=msg.chat_id,
+                    document=f,
+                    filename=export.EXPORT_FILENAME,
+                    caption='{} bills'.format(count)
+                )
+        except Exception as e:
+            logging.exception('export_bills')
+
+    @ordered
+    @acknowledges
     def done(self, bot, update):
         try:
-            conn = self.db.get_connection()
-            with Transaction(conn) as trans:
-                msg = update.message
-                user = msg.from_user
+            msg = update.message
+            user = msg.from_user
+            with self.get_transaction(user.id, chat_id=msg.chat_id) as trans:
                 trans.add_user(
                     user.id,
                     user.first_name,
                     user.last_name,
                     user.username
                 )
+                # Locks nothing when the session is cached; relies on @ordered
+                # running this chat's updates one at a time
                 act_type, act_id, subact_id, data = trans.get_session(
                     msg.chat_id,
                     msg.from_user.id,
@@ -122,19 +339,21 @@ class TelegramBot:
         except Exception as e:
             logging.exception('done')
 
-    @run_async
+    @ordered
+    @acknowledges
     def yes(self, bot, update):
         try:
-            conn = self.db.get_connection()
-            with Transaction(conn) as trans:
-                msg = update.message
-                user = msg.from_user
+            msg = update.message
+            user = msg.from_user
+            with self.get_transaction(user.id, chat_id=msg.chat_id) as trans:
                 trans.add_user(
                     user.id,
                     user.first_name,
                     user.last_name,
                     user.username
                 )
+                # Locks nothing when the session is cached; relies on @ordered
+                # running this chat's updates one at a time
                 act_type, act_id, subact_id, data = trans.get_session(
                     msg.chat_id,
                     msg.from_user.id,
@@ -146,19 +365,21 @@ class TelegramBot:
         except Exception as e:
             logging.exception('yes')
 
-    @run_async
+    @ordered
+    @acknowledges
     def no(self, bot, update):
         try:
-            conn = self.db.get_connection()
-            with Transaction(conn) as trans:
-                msg = update.message
-                user = msg.from_user
+            msg = update.message
+            user = msg.from_user
+            with self.get_transaction(user.id, chat_id=msg.chat_id) as trans:
                 trans.add_user(
                     user.id,
                     user.first_name,
                     user.last_name,
                     user.username
                 )
+                # Locks nothing when the session is cached; relies on @ordered
+                # running this chat's updates one at a time
                 act_type, act_id, subact_id, data = trans.get_session(
                     msg.chat_id,
                     msg.from_user.id,
@@ -170,14 +391,16 @@ class TelegramBot:
         except Exception as e:
             logging.exception('no')
 
-    @run_async
+    @ordered
+    @acknowledges
     def handle_all_msg(self, bot, update):
         try:
             if update.message.chat.type != PRIVATE_CHAT:
                 return
-            conn = self.db.get_connection()
             msg = update.message
-            with Transaction(conn) as trans:
+            with self.get_transaction(
+                msg.from_user.id, chat_id=msg.chat_id
+            ) as trans:
                 try:
                     user = update.message.from_user
                     trans.add_user(
@@ -186,6 +409,8 @@ class TelegramBot:
                         user.last_name,
                         user.username
                     )
+                    # Locks nothing when the session is cached; relies on @ordered
+                    # running this chat's updates one at a time
                     act_type, act_id, subact_id, data = trans.get_session(
                         msg.chat_id,
                         msg.from_user.id,
@@ -199,7 +424,8 @@ class TelegramBot:
         except Exception as e:
             logging.exception('handle_all_msg')
 
-    @run_async
+    @ordered
+    @acknowledges
     def handle_all_callback(self, bot, update):
         print("1. Received: " + str(datetime.datetime.now().time()))
         counter.Counter.add_count()
@@ -210,37 +436,64 @@ class TelegramBot:
             if data is None:
                 return cbq.answer()
 
-            conn = self.db.get_connection()
-            with Transaction(conn) as trans:
-                user = update.callback_query.from_user
-                trans.add_user(
-                    user.id,
-                    user.first_name,
-                    user.last_name,
-                    user.username
-                )
-                payload = json.loads(data)
-                action_type = payload.get(const.JSON_ACTION_TYPE)
-                action_id = payload.get(const.JSON_ACTION_ID)
-
-                if action_type is None:
-                    return cbq.answer('nothing')
-                print("1.1. Find handler: " + str(datetime.datetime.now().time()))
-                handler = self.get_action_handler(action_type)
-                print("2. Dispatched: " + str(datetime.datetime.now().time()))
-                return handler.execute(
-                    bot, update, trans, action_id, 0, payload
-                )
+            payload = json.loads(data)
+            action_type = payload.get(const.JSON_ACTION_TYPE)
+            action_id = payload.get(const.JSON_ACTION_ID)
+
+            if action_type is None:
+                return cbq.answer('nothing')
+
+            user = cbq.from_user
+            # Buttons of messages sent inline have no chat
+            chat_id = cbq.message.chat_id if cbq.message else None
+            read_only = self.is_read_only(action_type, action_id)
+            # Failures caused by archived bills are retried once they
+            # are restored, and actions that need a write are retried
+            # read-write
+            for __ in range(3):
+                trans = self.get_transaction(user.id, read_only, chat_id)
+                try:
+                    with trans:
+                        trans.add_user(
+                            user.id,
+                            user.first_name,
+                            user.last_name,
+                            user.username
+                        )
+                        data = dict(payload)
+                        bill_id = data.get(const.JSON_BILL_ID)
+                        if isinstance(bill_id, str):
+                            # Buttons sent before bills had numeric ids
+                            # carry the bill's token instead
+                            data[const.JSON_BILL_ID] = \
+                                trans.get_bill_id(bill_id)
+                        print("1.1. Find handler: " + str(datetime.datetime.now().time()))
+                        handler = self.get_action_handler(action_type)
+                        print("2. Dispatched: " + str(datetime.datetime.now().time()))
+                        handler.execute(
+                            bot, update, trans, action_id, 0, data
+                        )
+                except Exception as e:
+                    if len(trans.archived_bills) < 1:
+                        raise e
+                if trans.needs_write:
+                    read_only = False
+                elif not self.restore_archived_bills(user.id, trans):
+                    return
         except Exception as e:
             logging.exception('handle_all_callback')
 
-    @run_async
+    @ordered
+    @acknowledges
     def handle_inline(self, bot, update):
         try:
-            conn = self.db.get_connection()
             handler = self.get_action_handler(const.TYPE_SHARE_BILL)
-            with Transaction(conn) as trans:
-                user = update.inline_query.from_user
+            user = update.inline_query.from_user
+            read_only = self.is_read_only(
+                const.TYPE_SHARE_BILL,
+                share_bill_handler.ACTION_FIND_BILLS
+            )
+            with self.get_transaction(user.id, read_only) as trans:
                 trans.add_user(
                     user.id,
                     user.first_name,
@@ -256,20 +509,60 @@ class TelegramBot:
         except Exception as e:
             logging.exception('handle_inline')
 
+    @ordered
+    @acknowledges
+    def handle_chosen_inline(self, bot, update):
+        # Inline results are bill ids. Archived bills are shown as they are
+        # in inline search and only restored once one is actually sent.
+        try:
+            result = update.chosen_inline_result
+            with self.get_transaction(result.from_user.id) as trans:
+                trans.restore_bill(int(result.result_id))
+        except Exception as e:
+            logging.exception('handle_chosen_inline')
+
+    def restore_archived_bills(self, user_id, trans):
+        """\
+        Restores, on the primary, the archived bills that the read-only
+        trans ran into. Returns whether there were any.
+        """
+        if len(trans.archived_bills) < 1:
+            return False
+        with self.get_transaction(user_id) as restore_trans:
+            for bill_id in trans.archived_bills:
+                restore_trans.restore_bill(bill_id)
+        return True
+
+    def get_transaction(self, user_id, read_only=False, chat_id=None):
+        """\
+        Read-only transactions may be served by a replica. Writes are
+        recorded so that the next reads of the same user, and of anyone in
+        the same chat, stay on the primary.
+        """
+        conn = self.db.get_connection(
+            read_only=read_only,
+            user_id=user_id,
+            chat_id=chat_id
+        )
+        trans = Transaction(conn, read_only=read_only)
+        if not read_only:
+            trans.on_commit.append(
+                lambda: self.db.mark_write(user_id, chat_id)
+            )
+        return trans
+
     def get_action_handler(self, action_type):
-        if action_type == create_bill_handler.MODULE_ACTION_TYPE:
-            return create_bill_handler.BillCreationHandler()
-        if action_type == manage_bill_handler.MODULE_ACTION_TYPE:
-            return manage_bill_handler.BillManagementHandler()
-        if action_type == share_bill_handler.MODULE_ACTION_TYPE:
-            return share_bill_handler.BillShareHandler()
+        return registry.get_handler(action_type)
 
-        raise Exception("Action type '{}' unknown".format(action_type))
+    def is_read_only(self, action_type, action_id):
+        action = registry.get_action(action_type, action_id)
+        return action is not None and action.read_only
 
     def send_help_msg(self, bot, update):
         help_msg = ("Hi I'm here to help you create and manage your bills.\n\n"
         "You can control me by sending these commands: \n\n"
         "/newbill - Create a new bill \n\n"
+        "/export - Download all your bills \n\n"
         "Retrieve or share your bills by typing\n"
         "@WhoPayBot <i>bill name</i>\n"
         "in any chat.\n"
@@ -284,3 +577,17 @@ class TelegramBot:
 
 class BillError(Exception):
     pass
+
+
+def run_worker(token, db_config, cache_url, updates, acks):
+    """\
+    Entry point of a worker process. Builds its own Database and bot and
+    handles the updates routed to it.
+    """
+    logging.basicConfig(
+        format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    bot = TelegramBot(token, None, None, Database(**db_config), False,
+                      is_worker=True, cache_url=cache_url)
+    bot.serve_worker(updates, acks)
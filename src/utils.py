@@ -3,6 +3,8 @@ import json
 import constants as const
 import math
 import logging
+import functools
+from cache import render_cache
 
 
 def get_action_callback_data(action_type, action_id, data):
@@ -69,8 +71,12 @@ def format_complete_bill_text(bill, bill_id, trans):
 
 def get_complete_bill_text(bill_id, trans):
     try:
-        bill = trans.get_bill_details(bill_id)
-        return format_complete_bill_text(bill, bill_id, trans)
+        return render_cache.get(
+            'complete', bill_id, trans.get_bill_version(bill_id),
+            lambda: format_complete_bill_text(
+                trans.get_bill_details(bill_id), bill_id, trans
+            )
+        )
     except Exception as e:
         logging.exception('get_complete_bill_text')
 
@@ -114,8 +120,12 @@ def format_debts_bill_text(bill_id, debts, unique_users, trans):
 
 def get_debts_bill_text(bill_id, trans):
     try:
-        debts, unique_users = calculate_remaining_debt(bill_id, trans)
-        return format_debts_bill_text(bill_id, debts, unique_users, trans)
+        return render_cache.get(
+            'debts', bill_id, trans.get_bill_version(bill_id),
+            lambda: format_debts_bill_text(
+                bill_id, *calculate_remaining_debt(bill_id, trans), trans
+            )
+        )
     except Exception as e:
         logging.exception('get_debts_bill_text')
 
@@ -123,88 +133,38 @@ def get_debts_bill_text(bill_id, trans):
 def calculate_remaining_debt(bill_id, trans):
     unique_users = set()
     results = []
-    debts = trans.get_debts(bill_id)
-    if len(debts) < 1:
-        return []
-
     result = None
-    debtor = None
-    is_pending = False
-    is_forced = False
-    for i, debt in enumerate(debts):
+    for debt in trans.get_debts(bill_id):
         unique_users.add(debt[2])
         creditor = (debt[6], debt[7], debt[8], debt[9])
-        if result is None:
+        if result is None or result['creditor'] != creditor:
             result = {
                 'total_amt': 0,
                 'creditor': creditor,
                 'debtors': []
             }
-        if result['creditor'] != creditor:
             results.append(result)
-            result = {
-                'total_amt': 0,
-                'creditor': creditor,
-                'debtors': []
-            }
 
-        debt_id = debt[0]
-        if debtor is None:
-            debtor = {
-                'debtor': (debt[2], debt[3], debt[4], debt[5]),
-                'debt_id': debt_id,
-                'orig_amt': debt[1],
-                'amt': debt[1],
-                'status': '',
-            }
-            result['total_amt'] += debt[1]
-
-        if debtor['debt_id'] != debt_id:
-            if is_pending:
-                debtor['status'] = '(Pending)'
-            elif math.isclose(debtor['amt'], 0):
-                debtor['amt'] = 0
-                if is_forced:
-                    debtor['status'] = '<b>(Paid)</b>'
-                else:
-                    debtor['status'] = '(Paid)'
-            result['debtors'].append(debtor)
-
-            # Reset debtor info with new info
-            is_pending = False
-            is_forced = False
-            debtor = {
-                'debtor': (debt[2], debt[3], debt[4], debt[5]),
-                'debt_id': debt_id,
-                'orig_amt': debt[1],
-                'amt': debt[1],
-                'status': '',
-            }
-            result['total_amt'] += debt[1]
-
-        pay_amt = debt[10]
-        created_at = debt[11]
-        confirmed_at = debt[12]
-        is_deleted = debt[13]
-        is_forced = debt[14]
-
-        if not is_deleted:
-            if confirmed_at is not None:
-                debtor['amt'] -= pay_amt
+        debtor = {
+            'debtor': (debt[2], debt[3], debt[4], debt[5]),
+            'debt_id': debt[0],
+            'orig_amt': debt[1],
+            'amt': debt[1] - debt[10],
+            'status': '',
+        }
+        result['total_amt'] += debt[1]
+
+        is_pending = debt[11]
+        is_forced = debt[12]
+        if is_pending:
+            debtor['status'] = '(Pending)'
+        elif math.isclose(debtor['amt'], 0, abs_tol=1e-6):
+            debtor['amt'] = 0
+            if is_forced:
+                debtor['status'] = '<b>(Paid)</b>'
             else:
-                is_pending = is_pending or (created_at is not None)
-
-        if i >= len(debts) - 1:
-            if is_pending:
-                debtor['status'] = '(Pending)'
-            elif math.isclose(debtor['amt'], 0):
-                debtor['amt'] = 0
-                if is_forced:
-                    debtor['status'] = '<b>(Paid)</b>'
-                else:
-                    debtor['status'] = '(Paid)'
-            result['debtors'].append(debtor)
-            results.append(result)
+                debtor['status'] = '(Paid)'
+        result['debtors'].append(debtor)
 
     return results, len(unique_users)
 
@@ -216,6 +176,7 @@ def count_unique_users(sharers):
     return len(unique)
 
 
+@functools.lru_cache(maxsize=4096)
 def format_name(username, first_name, last_name):
     if first_name is not None and last_name is not None:
         return first_name + ' ' + last_name
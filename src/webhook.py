@@ -0,0 +1,110 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from telegram import Update
+import collections
+import threading
+import logging
+import json
+
+
+class UpdateDeduplicator:
+    """\
+    Remembers the last `size` update ids so that updates Telegram
+    re-delivers while we are slow to respond are only handled once.
+    """
+    def __init__(self, size=10000):
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.order = collections.deque()
+        self.size = size
+
+    def is_duplicate(self, update_id):
+        with self.lock:
+            if update_id in self.seen:
+                return True
+
+            self.seen.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.size:
+                self.seen.discard(self.order.popleft())
+            return False
+
+    def forget(self, update_id):
+        with self.lock:
+            self.seen.discard(update_id)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            return self.send_empty_response(403)
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return self.send_empty_response(400)
+
+        body = self.rfile.read(length)
+
+        # Acknowledge as soon as the update is stored, before handling it,
+        # so Telegram does not retry while we work
+        if self.server.handle_body(body):
+            self.send_empty_response(200)
+        else:
+            self.send_empty_response(500)
+
+    def do_GET(self):
+        self.send_empty_response(405)
+
+    def send_empty_response(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """\
+    Minimal webhook front end. Accepts update POSTs, drops duplicate
+    update ids and appends everything else to the durable ingest queue,
+    which hands updates on to the dispatcher.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, url_path, ingest_queue, deduplicator=None):
+        super().__init__(address, WebhookHandler)
+        self.url_path = '/' + url_path.lstrip('/')
+        self.ingest_queue = ingest_queue
+        self.deduplicator = deduplicator or UpdateDeduplicator()
+
+    def handle_body(self, body):
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except Exception as e:
+            # Malformed bodies are dropped, retrying them cannot help
+            logging.exception('handle_body')
+            return True
+
+        update_id = payload.get('update_id')
+        if (update_id is not None and
+                self.deduplicator.is_duplicate(update_id)):
+            return True
+
+        try:
+            self.ingest_queue.put(payload)
+            return True
+        except Exception as e:
+            logging.exception('handle_body')
+            if update_id is not None:
+                self.deduplicator.forget(update_id)
+            return False
+
+
+def to_update(row_id, payload, bot):
+    update = Update.de_json(payload, bot)
+    update.ingest_id = row_id
+    return update
@@ -0,0 +1,92 @@
+import multiprocessing
+import threading
+import logging
+
+
+def get_chat_id(payload):
+    """\
+    Returns the id used to shard a raw update: the chat it belongs to, or
+    the sender for updates that have no chat (inline queries, callbacks
+    from inline messages).
+    """
+    for key in ('message', 'edited_message', 'channel_post',
+                'edited_channel_post'):
+        msg = payload.get(key)
+        if msg is not None:
+            return msg['chat']['id']
+
+    cbq = payload.get('callback_query')
+    if cbq is not None:
+        msg = cbq.get('message')
+        if msg is not None:
+            return msg['chat']['id']
+        return cbq['from']['id']
+
+    for key in ('inline_query', 'chosen_inline_result'):
+        query = payload.get(key)
+        if query is not None:
+            return query['from']['id']
+
+    return 0
+
+
+class WorkerPool:
+    """\
+    Routes updates to worker processes by chat id, so all updates of a
+    chat are handled, in order, by the same process. Each worker builds
+    its own db pool and caches. Workers send the ingest ids of finished
+    updates back through the shared acks queue.
+    """
+    def __init__(self, num_workers, target, args, on_ack):
+        # spawn so workers do not inherit the parent's threads and sockets
+        self.context = multiprocessing.get_context('spawn')
+        self.target = target
+        self.args = args
+        self.on_ack = on_ack
+        self.acks = self.context.Queue()
+        self.queues = [self.context.Queue() for __ in range(num_workers)]
+        self.processes = [None] * num_workers
+        self.lock = threading.Lock()
+
+    def start(self):
+        for i in range(len(self.queues)):
+            self.start_worker(i)
+
+        ack_thread = threading.Thread(
+            target=self.forward_acks,
+            name='worker_acks',
+            daemon=True
+        )
+        ack_thread.start()
+
+    def start_worker(self, index):
+        process = self.context.Process(
+            target=self.target,
+            args=self.args + (self.queues[index], self.acks),
+            name='worker-{}'.format(index),
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def route(self, row_id, payload):
+        index = get_chat_id(payload) % len(self.queues)
+        with self.lock:
+            if not self.processes[index].is_alive():
+                logging.warning('Restarting worker {}'.format(index))
+                self.start_worker(index)
+        self.queues[index].put((row_id, payload))
+
+    def forward_acks(self):
+        while True:
+            row_id = self.acks.get()
+            try:
+                self.on_ack(row_id)
+            except Exception as e:
+                logging.exception('forward_acks')
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for process in self.processes:
+            process.join()